@@ -0,0 +1,300 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import contextlib
+import numpy as np
+import numba
+from lbm_engine.lbm_descriptors import D2Q9, D3Q19, D3Q7
+from lbm_engine.lbm_collisionOperators import (BGK_collisionOperator2D, BGK_collisionOperator3D,
+                                               BGK_AdvectionDiffusion_collisionOperator)
+from lbm_engine.lbm_simulationcore import (Lattice2D, Lattice3D, SparseLattice3D, ScalarLattice2D, ScalarLattice3D,
+                                           CoupledLattice3D)
+from lbm_engine.lbm_operators import (BounceBack2D, BounceBack3D, VelocityDirichlet2D, VelocityDirichlet3D,
+                                      PressureDirichlet2D, PressureDirichlet3D, PulsedConcentrationDirichlet,
+                                      ConstantScalarDirichlet, ZeroGradientOutlet, ConstantScalarDirichlet3D,
+                                      ZeroGradientOutlet3D)
+
+""" Benchmark suite for the engine without any plotting or file output: times the step of all lattice classes
+(every streaming mode and memory layout, dense and sparse porous lattices at several porosities) and the apply of
+every operator in lbm_operators.py, for several grid sizes and numba thread counts. The JIT compilation is done
+before timing, every case is timed `repeat` times and the best run counts.
+Reported are MLUPS (million lattice updates per second, for the operators million boundary cells per second)
+and the memory bandwidth that corresponds to it (estimated bytes per cell update, see traffic()), with
+--peak-bandwidth also in % of the machine's peak. Results go to a JSON file, --compare old.json shows the
+ratio to an older run and exits with 1 if a case got slower than --tolerance.
+Run from the repository root:
+    python -m benchmarks.benchmark_suite --output results.json
+    python -m benchmarks.benchmark_suite --preset full --threads 1 4 8 --compare results.json
+Thread counts above NUMBA_NUM_THREADS (default: all cores) can't be used, set it in the environment for more """
+
+#Benchmark Setup
+PRESETS = {
+    "quick": {"sizes2D": [(300, 100), (1000, 1000)], "sizes3D": [(64, 64, 64)], "porosities": [0.4, 0.8]},
+    "full": {"sizes2D": [(300, 100), (1000, 1000), (4000, 4000)], "sizes3D": [(64, 64, 64), (128, 128, 128), (256, 256, 256)],
+             "porosities": [0.2, 0.4, 0.6, 0.8]},
+}
+
+
+def quiet(factory, *args, **kwargs):
+    #the lattice constructors print their collision operator, we don't want that between the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        return factory(*args, **kwargs)
+
+
+def traffic(Q, D, itemsize, index_itemsize=0):
+    #bytes moved per cell update: read + write of the Q populations, the moments written (rho/phi + D velocities)
+    #and for the sparse lattice the neighbour table
+    return 2 * Q * itemsize + (1 + D) * itemsize + Q * index_itemsize
+
+
+def random_solid(shape, porosity, seed=0):
+    #uncorrelated random solid, shape in (x, y, z) like the meshgrid masks
+    return np.random.default_rng(seed).random(shape) >= porosity
+
+
+def time_calls(call, min_time, repeat):
+    #call once to compile, a second time to estimate the cost, then time `repeat` runs of at least min_time
+    call()
+    start = time.perf_counter()
+    call()
+    single = max(time.perf_counter() - start, 1e-7)
+    calls = max(int(min_time / single), 1)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            call()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+##Lattice cases, each returns (lattice, updated cells, bytes per update)
+def lattice2D(size, **kwargs):
+    nx, ny = size
+    sim = quiet(Lattice2D, nx, ny, D2Q9(), BGK_collisionOperator2D(tau=0.6), **kwargs)
+    return sim, nx * ny, traffic(9, 2, sim.dtype.itemsize)
+
+
+def lattice3D(size, **kwargs):
+    nx, ny, nz = size
+    sim = quiet(Lattice3D, nx, ny, nz, D3Q19(), BGK_collisionOperator3D(tau=0.6), **kwargs)
+    return sim, nx * ny * nz, traffic(19, 3, sim.dtype.itemsize)
+
+
+def porous3D(size, porosity):
+    #dense lattice, the solid is bounced back by an operator but every cell is still streamed
+    sim, cells, bytes_per_update = lattice3D(size)
+    sim.addOperator("solid", BounceBack3D(sim.descriptor, random_solid(size, porosity)))
+    return sim, cells, bytes_per_update
+
+
+def sparse3D(size, porosity):
+    nx, ny, nz = size
+    sim = quiet(SparseLattice3D, nx, ny, nz, D3Q19(), BGK_collisionOperator3D(tau=0.6), random_solid(size, porosity))
+    return sim, sim.N, traffic(19, 3, sim.dtype.itemsize, sim.src.dtype.itemsize)
+
+
+def scalar2D(size):
+    nx, ny = size
+    sim = quiet(ScalarLattice2D, nx, ny, D2Q9(), BGK_AdvectionDiffusion_collisionOperator(tau=0.7))
+    sim.u[..., 0] = 0.05
+    return sim, nx * ny, traffic(9, 0, sim.dtype.itemsize)
+
+
+def scalar3D(size):
+    nx, ny, nz = size
+    sim = quiet(ScalarLattice3D, nx, ny, nz, D3Q7(), BGK_AdvectionDiffusion_collisionOperator(tau=0.7))
+    sim.u[..., 0] = 0.05
+    return sim, nx * ny * nz, traffic(7, 0, sim.dtype.itemsize)
+
+
+def coupled3D(size):
+    nx, ny, nz = size
+    sim = quiet(CoupledLattice3D, nx, ny, nz, D3Q19(), BGK_collisionOperator3D(tau=0.6), D3Q7(),
+                BGK_AdvectionDiffusion_collisionOperator(tau=0.7), buoyancy=(0.0, 0.0, 1e-4))
+    return sim, nx * ny * nz, traffic(19, 3, sim.dtype.itemsize) + traffic(7, 0, sim.dtype.itemsize)
+
+
+def lattice_cases(preset):
+    #(name, variant, size, factory)
+    cases = []
+    for size in preset["sizes2D"]:
+        for variant, kwargs in (("pull-aos", {}), ("pull-soa", {"layout": "soa"}), ("aa-aos", {"streaming": "aa"}),
+                                ("pull-aos-f32", {"dtype": np.float32, "store_deviation": True})):
+            cases.append(("Lattice2D", variant, size, lambda size=size, kwargs=kwargs: lattice2D(size, **kwargs)))
+        cases.append(("ScalarLattice2D", "pull", size, lambda size=size: scalar2D(size)))
+    for size in preset["sizes3D"]:
+        for variant, kwargs in (("pull-aos", {}), ("pull-soa", {"layout": "soa"}), ("aa-aos", {"streaming": "aa"}),
+                                ("pull-aos-f32", {"dtype": np.float32, "store_deviation": True})):
+            cases.append(("Lattice3D", variant, size, lambda size=size, kwargs=kwargs: lattice3D(size, **kwargs)))
+        for porosity in preset["porosities"]:
+            cases.append(("Lattice3D+BounceBack3D", f"porosity={porosity}", size, lambda size=size, p=porosity: porous3D(size, p)))
+            cases.append(("SparseLattice3D", f"porosity={porosity}", size, lambda size=size, p=porosity: sparse3D(size, p)))
+        cases.append(("ScalarLattice3D", "D3Q7", size, lambda size=size: scalar3D(size)))
+        cases.append(("CoupledLattice3D", "D3Q19+D3Q7", size, lambda size=size: coupled3D(size)))
+    return cases
+
+
+##Operator cases, each returns (operator, arrays passed to apply, cells touched)
+def inlet(size):
+    #x == 0 plane in (x, y[, z])
+    mask = np.zeros(size, dtype=bool)
+    mask[0] = True
+    return mask
+
+
+def flow_operator(sim, name, operator):
+    sim.addOperator(name, operator)
+    return operator, (sim.f, sim.u, sim.rho), len(operator.cells)
+
+
+def scalar_operator(sim, name, operator):
+    sim.addOperator(name, operator)
+    return operator, (sim.g, sim.u, sim.phi), len(operator.cells)
+
+
+def velocity(shape):
+    u = np.zeros(shape)
+    u[..., 0] = 0.05
+    return u
+
+
+def operator_cases(preset):
+    cases = []
+    for size in preset["sizes2D"]:
+        d, c = D2Q9(), BGK_collisionOperator2D(tau=0.6)
+
+        def flow(size=size):
+            return quiet(Lattice2D, size[0], size[1], D2Q9(), BGK_collisionOperator2D(tau=0.6))
+
+        def scalar(size=size):
+            return scalar2D(size)[0]
+
+        cases += [
+            ("BounceBack2D", size, lambda flow=flow, d=d, size=size: flow_operator(flow(), "o", BounceBack2D(d, random_solid(size, 0.6)))),
+            ("VelocityDirichlet2D", size, lambda flow=flow, d=d, c=c, size=size: flow_operator(flow(), "o", VelocityDirichlet2D(d, c, inlet(size), velocity))),
+            ("PressureDirichlet2D", size, lambda flow=flow, d=d, c=c, size=size: flow_operator(flow(), "o", PressureDirichlet2D(d, c, inlet(size), 1.0))),
+            ("PulsedConcentrationDirichlet", size, lambda scalar=scalar, d=d, size=size: scalar_operator(scalar(), "o", PulsedConcentrationDirichlet(d, inlet(size), 0.0, 1.0, t_end=10**9))),
+            ("ConstantScalarDirichlet", size, lambda scalar=scalar, d=d, size=size: scalar_operator(scalar(), "o", ConstantScalarDirichlet(d, inlet(size), 1.0))),
+            ("ZeroGradientOutlet", size, lambda scalar=scalar, d=d, size=size: scalar_operator(scalar(), "o", ZeroGradientOutlet(d, inlet(size)))),
+        ]
+    for size in preset["sizes3D"]:
+        d, c, d7 = D3Q19(), BGK_collisionOperator3D(tau=0.6), D3Q7()
+
+        def flow(size=size):
+            return quiet(Lattice3D, *size, D3Q19(), BGK_collisionOperator3D(tau=0.6))
+
+        def scalar(size=size):
+            return scalar3D(size)[0]
+
+        cases += [
+            ("BounceBack3D", size, lambda flow=flow, d=d, size=size: flow_operator(flow(), "o", BounceBack3D(d, random_solid(size, 0.6)))),
+            ("VelocityDirichlet3D", size, lambda flow=flow, d=d, c=c, size=size: flow_operator(flow(), "o", VelocityDirichlet3D(d, c, inlet(size), velocity))),
+            ("PressureDirichlet3D", size, lambda flow=flow, d=d, c=c, size=size: flow_operator(flow(), "o", PressureDirichlet3D(d, c, inlet(size), 1.0))),
+            ("ConstantScalarDirichlet3D", size, lambda scalar=scalar, d=d7, size=size: scalar_operator(scalar(), "o", ConstantScalarDirichlet3D(d, inlet(size), 1.0))),
+            ("ZeroGradientOutlet3D", size, lambda scalar=scalar, d=d7, size=size: scalar_operator(scalar(), "o", ZeroGradientOutlet3D(d, inlet(size)))),
+        ]
+    return cases
+
+
+def run_suite(preset, threads, min_time, repeat, peak_bandwidth, only=None):
+    results = []
+    print(f"{'Case':<30}{'Variant':<16}{'Size':<16}{'Threads':>8}{'MLUPS':>10}{'GB/s':>9}{'% peak':>8}")
+    for n_threads in threads:
+        numba.set_num_threads(n_threads)
+        for name, variant, size, factory in lattice_cases(preset):
+            if only and not any(word in name for word in only):
+                continue
+            sim, cells, bytes_per_update = factory()
+            seconds = time_calls(sim.step, min_time, repeat)
+            results.append(report(name, variant, size, n_threads, cells / seconds / 1e6, bytes_per_update, peak_bandwidth, seconds))
+            del sim
+        for name, size, factory in operator_cases(preset):
+            if only and not any(word in name for word in only):
+                continue
+            operator, arrays, cells = factory()
+            seconds = time_calls(lambda: operator.apply(*arrays), min_time, repeat)
+            results.append(report(name, "apply", size, n_threads, cells / seconds / 1e6, None, peak_bandwidth, seconds))
+    return results
+
+
+def report(name, variant, size, n_threads, mlups, bytes_per_update, peak_bandwidth, seconds):
+    bandwidth = mlups * bytes_per_update / 1e3 if bytes_per_update else None
+    utilisation = 100 * bandwidth / peak_bandwidth if bandwidth is not None and peak_bandwidth else None
+    size_text = "x".join(map(str, size))
+    print(f"{name:<30}{variant:<16}{size_text:<16}{n_threads:>8}{mlups:>10.2f}"
+          f"{'' if bandwidth is None else f'{bandwidth:.2f}':>9}{'' if utilisation is None else f'{utilisation:.1f}':>8}")
+    return {"case": name, "variant": variant, "size": list(size), "threads": n_threads, "mlups": mlups,
+            "seconds_per_call": seconds, "bytes_per_update": bytes_per_update, "bandwidth_gbs": bandwidth,
+            "bandwidth_utilisation": utilisation}
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "preset": args.preset,
+            "python": platform.python_version(), "numpy": np.__version__, "numba": numba.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "numba_threads": numba.config.NUMBA_NUM_THREADS, "threading_layer": numba.config.THREADING_LAYER,
+            "peak_bandwidth_gbs": args.peak_bandwidth}
+
+
+def compare(results, baseline_file, tolerance):
+    #ratio new/old MLUPS for all cases in both runs, returns True if nothing got slower than tolerance
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+
+    def key(r):
+        return (r["case"], r["variant"], tuple(r["size"]), r["threads"])
+
+    old = {key(r): r for r in baseline["results"]}
+    print(f"\nCompared to {baseline_file} (commit {baseline['meta'].get('commit')}):")
+    ok = True
+    for r in results:
+        if key(r) not in old:
+            continue
+        ratio = r["mlups"] / old[key(r)]["mlups"]
+        slower = ratio < 1.0 - tolerance
+        ok &= not slower
+        size_text = "x".join(map(str, r["size"]))
+        print(f"{r['case']:<30}{r['variant']:<16}{size_text:<16}{r['threads']:>8}{ratio:>10.2f}{'  REGRESSION' if slower else ''}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LBM engine benchmark suite (MLUPS)")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="numba thread counts to run (default: 1 and NUMBA_NUM_THREADS)")
+    parser.add_argument("--only", nargs="+", default=None, help="only cases whose name contains one of these words")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per timed run")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best one counts")
+    parser.add_argument("--peak-bandwidth", type=float, default=None, help="peak memory bandwidth of the machine in GB/s")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="JSON of an older run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    threads = args.threads or sorted({1, numba.config.NUMBA_NUM_THREADS})
+    too_many = [t for t in threads if t > numba.config.NUMBA_NUM_THREADS]
+    if too_many:
+        parser.error(f"thread counts {too_many} are above NUMBA_NUM_THREADS={numba.config.NUMBA_NUM_THREADS}")
+
+    results = run_suite(PRESETS[args.preset], threads, args.min_time, args.repeat, args.peak_bandwidth, args.only)
+    with open(args.output, "w") as file:
+        json.dump({"meta": metadata(args), "results": results}, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare is not None and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import numpy as np
+from numba import njit, prange
+from lbm_engine.lbm_operators import BounceBack3D
+
+""" This file contains some post processing for the 3D porous media runs. Instead of dumping u/rho to VTI every step
+and computing the permeability offline, the numba kernel below reduces the fields plane by plane along the flow axis
+and everything else (porosity, pressure gradient, tortuosity, Darcy permeability) is computed from these few numbers.
+All values are in lattice units. The flow axis is given like the masks from meshgrid(..., indexing="ij"): 0 = x, 1 = y, 2 = z """
+
+#columns of the plane sums
+PLANE_FLUX = 0        #sum of the velocity component along the flow axis
+PLANE_SPEED = 1       #sum of |u|
+PLANE_RHO = 2         #sum of rho
+PLANE_FLUID = 3       #number of fluid cells
+
+
+@njit(parallel=True)
+def plane_sums(u, rho, solid, axis):
+    #axis is the array axis of the (z, y, x) fields, every z plane gets its own accumulator so the threads don't race
+    nz, ny, nx = rho.shape
+    n_planes = rho.shape[axis]
+    component = 2 - axis
+    partial = np.zeros((nz, n_planes, 4))
+
+    for z in prange(nz):
+        for y in range(ny):
+            for x in range(nx):
+                if solid[z, y, x]:
+                    continue
+                #prange gives an unsigned z, cast so p doesn't end up as a float
+                if axis == 2:
+                    p = np.int64(x)
+                elif axis == 1:
+                    p = np.int64(y)
+                else:
+                    p = np.int64(z)
+                ux = u[z, y, x, 0]
+                uy = u[z, y, x, 1]
+                uz = u[z, y, x, 2]
+                partial[z, p, PLANE_FLUX] += u[z, y, x, component]
+                partial[z, p, PLANE_SPEED] += np.sqrt(ux * ux + uy * uy + uz * uz)
+                partial[z, p, PLANE_RHO] += rho[z, y, x]
+                partial[z, p, PLANE_FLUID] += 1.0
+
+    sums = np.zeros((n_planes, 4))
+    for z in range(nz):
+        for p in range(n_planes):
+            for k in range(4):
+                sums[p, k] += partial[z, p, k]
+    return sums
+
+
+def solid_mask(lattice):
+    #all cells of the BounceBack3D operators of the lattice, in (z, y, x)
+    solid = np.zeros((lattice.nz, lattice.ny, lattice.nx), dtype=np.uint8)
+    for operator in lattice.geometry.values():
+        if isinstance(operator, BounceBack3D):
+            mask = operator.mask
+            mask = np.transpose(mask, (2, 1, 0)) if mask.shape != solid.shape else mask
+            solid[mask.astype(bool)] = 1
+    return solid
+
+
+def _orient_solid(lattice, solid):
+    if solid is None:
+        return solid_mask(lattice)
+    solid = np.asarray(solid, dtype=bool)
+    solid = np.transpose(solid, (2, 1, 0)) if solid.shape != (lattice.nz, lattice.ny, lattice.nx) else solid
+    return np.ascontiguousarray(solid, dtype=np.uint8)
+
+
+def plane_profiles(lattice, axis=0, solid=None):
+    """ Plane averaged profiles along the flow axis: volumetric flux (sum of u_axis over the plane), porosity,
+    mean fluid velocity and mean fluid pressure cs2*rho of every plane.
+    solid defaults to the cells of the BounceBack3D operators of the lattice """
+    solid = _orient_solid(lattice, solid)
+    sums = plane_sums(lattice.u, lattice.rho, solid, 2 - axis)
+    area = lattice.nx * lattice.ny * lattice.nz / sums.shape[0]
+    fluid = np.maximum(sums[:, PLANE_FLUID], 1.0)
+    return {
+        "flux": sums[:, PLANE_FLUX],
+        "porosity": sums[:, PLANE_FLUID] / area,
+        "velocity": sums[:, PLANE_FLUX] / fluid,
+        "pressure": lattice.descriptor.cs2 * sums[:, PLANE_RHO] / fluid,
+    }
+
+
+def _reduce(sums, region, cs2, nu, area):
+    #scalars of the planes [start, stop) from the plane sums
+    start, stop = region
+    s = sums[start:stop]
+    fluid = s[:, PLANE_FLUID].sum()
+    flux = s[:, PLANE_FLUX].sum()
+
+    #least squares slope of the mean plane pressure, planes without fluid are left out
+    has_fluid = s[:, PLANE_FLUID] > 0
+    position = np.arange(start, stop)[has_fluid]
+    pressure = cs2 * s[has_fluid, PLANE_RHO] / s[has_fluid, PLANE_FLUID]
+    dpdx = np.polyfit(position, pressure, 1)[0] if position.size > 1 else np.nan
+
+    rho_mean = s[:, PLANE_RHO].sum() / fluid if fluid > 0 else np.nan
+    q = flux / (area * (stop - start))                                  #superficial (Darcy) velocity
+    return {
+        "porosity": fluid / (area * (stop - start)),
+        "flux": flux / (stop - start),                                  #mean volumetric flux through a plane
+        "darcy_velocity": q,
+        "pressure_gradient": dpdx,
+        "tortuosity": s[:, PLANE_SPEED].sum() / abs(flux) if flux != 0 else np.nan,
+        "permeability": -nu * rho_mean * q / dpdx if dpdx != 0 else np.nan,
+    }
+
+
+def porous_media_stats(lattice, axis=0, solid=None, region=None):
+    """ Porosity, mean flux, Darcy velocity, mean pressure gradient, tortuosity (<|u|> / <u_axis>) and the Darcy
+    permeability k = -nu * rho * q / (dp/dx) of the planes region=(start, stop) along the flow axis.
+    The default region leaves out the first and the last plane where inlet and outlet sit """
+    solid = _orient_solid(lattice, solid)
+    sums = plane_sums(lattice.u, lattice.rho, solid, 2 - axis)
+    n_planes = sums.shape[0]
+    region = (1, n_planes - 1) if region is None else region
+    nu = lattice.descriptor.cs2 * (lattice.collisionOperator.tau - 0.5)
+    return _reduce(sums, region, lattice.descriptor.cs2, nu, lattice.nx * lattice.ny * lattice.nz / n_planes)
+
+
+class PorousMediaMonitor3D:
+    """ Records porous_media_stats of a Lattice3D every interval steps into a small time series, use step()/run()
+    instead of stepping the lattice directly (or call record() yourself). The solid mask is taken once
+    when the monitor is created, so add the BounceBack3D operators before that or pass solid.
+    series gives a dict of arrays (t, porosity, flux, ...), save() writes them as csv """
+    QUANTITIES = ("porosity", "flux", "darcy_velocity", "pressure_gradient", "tortuosity", "permeability")
+
+    def __init__(self, lattice, axis=0, solid=None, region=None, interval=100):
+        self.lattice = lattice
+        self.axis = axis
+        self.solid = _orient_solid(lattice, solid)
+        self.interval = interval
+        n_planes = (lattice.nx, lattice.ny, lattice.nz)[axis]
+        self.region = (1, n_planes - 1) if region is None else region
+        self.nu = lattice.descriptor.cs2 * (lattice.collisionOperator.tau - 0.5)
+        self.area = lattice.nx * lattice.ny * lattice.nz / n_planes
+        self._rows = []
+
+    def measure(self):
+        sums = plane_sums(self.lattice.u, self.lattice.rho, self.solid, 2 - self.axis)
+        return _reduce(sums, self.region, self.lattice.descriptor.cs2, self.nu, self.area)
+
+    def record(self):
+        stats = self.measure()
+        self._rows.append((self.lattice.t,) + tuple(stats[name] for name in self.QUANTITIES))
+        return stats
+
+    def step(self):
+        self.lattice.step()
+        if self.lattice.t % self.interval == 0:
+            self.record()
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.step()
+
+    @property
+    def series(self):
+        rows = np.array(self._rows, dtype=np.float64).reshape(-1, len(self.QUANTITIES) + 1)
+        series = {"t": rows[:, 0].astype(np.int64)}
+        for k, name in enumerate(self.QUANTITIES):
+            series[name] = rows[:, k + 1]
+        return series
+
+    def save(self, filename):
+        rows = np.array(self._rows, dtype=np.float64).reshape(-1, len(self.QUANTITIES) + 1)
+        np.savetxt(filename, rows, delimiter=",", header=",".join(("t",) + self.QUANTITIES), comments="")
@@ -1,24 +1,36 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 """ This file contains Collison Operators like BGK and Advection Diffusion BGK 
 The implementation is pretty simple and you should be able to add your own 
 Operators based on the main CollisionOperator """
 
+#collision models the fused stream&collide kernels know about, see CollisionOperator.relaxation
+MODEL_BGK = 0
+MODEL_TRT = 1
+MODEL_MRT = 2
+
 class CollisionOperator:
     def __init__(self, tau):
         pass
-    def compute_feq(self, rho=None, u=None,mask = None):
+    def compute_feq(self, rho=None, u=None,mask = None, dtype=None):
         pass
 
+    def relaxation(self, descriptor):
+        """ Everything the fused lattice kernels need to collide: (model, omega+, omega-, K, opp).
+        BGK only uses omega+ = 1/tau, TRT relaxes the symmetric/antisymmetric part of f - feq with omega+/omega-
+        and MRT uses the full Q x Q collision matrix K = M^-1 S M. The default is plain BGK """
+        omega = 1.0 / self.tau
+        return (MODEL_BGK, omega, omega, np.zeros((0, 0)), np.asarray(descriptor.opp, dtype=np.int64))
+
 @njit(parallel=True)
-def compute_feq_numba(e, w, rho, u):
+def compute_feq_numba(e, w, rho, u, feq):
+    #feq is the (nz, ny, nx, Q) output array, its dtype decides the precision f is stored in
     nz, ny, nx = rho.shape
     Q = e.shape[0]
-    feq = np.zeros((nz, ny, nx, Q))
-    for i in range(Q):
-        for z in range(nz):
-            for y in range(ny):
-                for x in range(nx):
+    for z in prange(nz):
+        for y in range(ny):
+            for x in range(nx):
+                for i in range(Q):
                     cu = 0.0
                     u2 = 0.0
                     for d in range(3):
@@ -26,29 +38,76 @@ def compute_feq_numba(e, w, rho, u):
                         u2 += u[z, y, x, d]**2
                     feq[z, y, x, i] = w[i] * rho[z, y, x] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
     return feq
+
+##Per cell helpers for the fused kernels (lbm_simulationcore), feq and neq are small (Q,) scratch arrays
+@njit
+def equilibrium_cell2D(feq, rho, ux, uy, e, w, shift):
+    u2 = ux**2 + uy**2
+    for i in range(feq.shape[0]):
+        cu = ux * e[i, 0] + uy * e[i, 1]
+        feq[i] = w[i] * rho * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+
+@njit
+def equilibrium_cell3D(feq, rho, ux, uy, uz, e, w, shift):
+    u2 = ux**2 + uy**2 + uz**2
+    for i in range(feq.shape[0]):
+        cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+        feq[i] = w[i] * rho * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+
+@njit
+def relax_cell(fc, feq, model, omega, omega_m, K, opp, neq):
+    #relax the populations fc of one cell in place
+    Q = fc.shape[0]
+    if model == MODEL_TRT:
+        for i in range(Q):
+            j = opp[i]
+            if j < i:
+                continue
+            a = fc[i] - feq[i]
+            if j == i:
+                fc[i] -= omega * a
+                continue
+            b = fc[j] - feq[j]
+            sym = 0.5 * (a + b)
+            anti = 0.5 * (a - b)
+            fc[i] -= omega * sym + omega_m * anti
+            fc[j] -= omega * sym - omega_m * anti
+    elif model == MODEL_MRT:
+        for i in range(Q):
+            neq[i] = fc[i] - feq[i]
+        for i in range(Q):
+            s = 0.0
+            for j in range(Q):
+                s += K[i, j] * neq[j]
+            fc[i] -= s
+    else:
+        for i in range(Q):
+            fc[i] += -omega * (fc[i] - feq[i])
+
 class BGK_collisionOperator2D(CollisionOperator):
     def __init__(self, tau):
         self.tau = tau
-    def compute_feq(self, descriptor, rho, u, mask=None):
-        ny, nx = rho.shape
+    def compute_feq(self, descriptor, rho, u, mask=None, dtype=None):
+        #dtype of the result, defaults to the dtype of rho
+        #rho can be the (ny, nx) field or just a list of cells (N,) with u (N, 2), e.g. the cells of a boundary
         Q = descriptor.Q
         e = descriptor.e
         w = descriptor.w
 
-        u2 = u[:,:,0]**2 + u[:,:,1]**2
-        feq = np.zeros((ny, nx, Q))
+        u2 = u[..., 0]**2 + u[..., 1]**2
+        feq = np.zeros((*rho.shape, Q), dtype=dtype or rho.dtype)
 
         for i in range(Q):
             #scalar product for convective term
-            cu = u[:,:,0]*e[i,0] + u[:,:,1]*e[i,1]
+            cu = u[..., 0]*e[i,0] + u[..., 1]*e[i,1]
             #lbm equilibrium for equilibrium distribution function
-            feq[:,:,i] = w[i] * rho * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
+            feq[..., i] = w[i] * rho * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
 
         #if mask is specified -> just apply operator to masked area
         if mask is not None:
             feq_masked = np.zeros_like(feq)
             for i in range(Q):
-                feq_masked[:,:,i][mask] = feq[:,:,i][mask]
+                feq_masked[..., i][mask] = feq[..., i][mask]
             return feq_masked
         return feq
     
@@ -67,8 +126,9 @@ class BGK_collisionOperator3D(CollisionOperator):
     def __init__(self, tau):
         self.tau = tau
 
-    def compute_feq(self, descriptor, rho, u, mask=None):
-        feq = compute_feq_numba(descriptor.e, descriptor.w, rho, u)
+    def compute_feq(self, descriptor, rho, u, mask=None, dtype=None):
+        feq = np.empty((*rho.shape, descriptor.Q), dtype=dtype or rho.dtype)
+        compute_feq_numba(descriptor.e, descriptor.w, rho, u, feq)
 
         if mask is not None:
             feq_masked = np.zeros_like(feq)
@@ -86,17 +146,22 @@ class BGK_collisionOperator3D(CollisionOperator):
 class BGK_AdvectionDiffusion_collisionOperator(CollisionOperator):
     def __init__(self, tau):
         self.tau = tau
-    def compute_feq(self, descriptor, phi, u, mask = None):
+    def compute_feq(self, descriptor, phi, u, mask = None, dtype=None):
         Q = descriptor.Q
         e = descriptor.e
         w = descriptor.w
 
-        feq = np.zeros((*phi.shape, Q))
+        #works for 2D (D2Q9) and 3D (D3Q7) fields, like BGK_collisionOperator2D also on a (N,) list of cells
+        #1/cs^2 is 3 for D2Q9 and 4 for D3Q7
+        inv_cs2 = 1.0 / getattr(descriptor, "cs2", 1/3)
+        feq = np.zeros((*phi.shape, Q), dtype=dtype or phi.dtype)
         for i in range(Q):
             #scalar product for convective term
-            cu = u[:, :, 0]*e[i, 0] + u[:, :, 1]*e[i, 1]
+            cu = u[..., 0]*e[i, 0] + u[..., 1]*e[i, 1]
+            for d in range(2, u.shape[-1]):
+                cu = cu + u[..., d]*e[i, d]
             #equilibrium distribution function for diffusion problem
-            feq[:, :, i] = w[i] * phi * (1 + 3*cu)
+            feq[..., i] = w[i] * phi * (1 + inv_cs2*cu)
         return feq
     
     def compute_delta_f(self, descriptor, f_lattice, phi, u, mask = None):
@@ -105,4 +170,145 @@ class BGK_AdvectionDiffusion_collisionOperator(CollisionOperator):
         -- but it works atm so idgaf """
         feq = self.compute_feq(descriptor, phi, u, mask)
         delta_f = -(1.0 / self.tau) * (f_lattice - feq)
-        return delta_f
\ No newline at end of file
+        return delta_f
+
+
+#########
+## TRT and MRT
+#both only change how f - feq is relaxed, so they reuse the BGK equilibria. On the lattices they run inside the fused
+#stream&collide kernels (through relaxation()), compute_delta_f is just the plain numpy version of the same thing
+
+class TRT_collisionOperator(CollisionOperator):
+    """ Two relaxation time operator: the symmetric part of f - feq relaxes with 1/tau (sets the viscosity like BGK),
+    the antisymmetric part with 1/tau_minus. tau_minus follows from the magic parameter
+    (tau - 1/2)(tau_minus - 1/2) = magic, 1/4 is the usual choice, 3/16 puts bounce-back walls exactly halfway.
+    For tau very close to 1/2 in strongly sheared flows MRT is the more robust one """
+    def __init__(self, tau, magic=0.25):
+        self.tau = tau
+        self.magic = magic
+
+    @property
+    def tau_minus(self):
+        return self.magic / (self.tau - 0.5) + 0.5
+
+    def relaxation(self, descriptor):
+        return (MODEL_TRT, 1.0 / self.tau, 1.0 / self.tau_minus, np.zeros((0, 0)),
+                np.asarray(descriptor.opp, dtype=np.int64))
+
+    def compute_delta_f(self, descriptor, f_lattice, rho, u, mask=None):
+        neq = f_lattice - self.compute_feq(descriptor, rho, u, mask)
+        neq_opp = neq[..., descriptor.opp]
+        return -(1.0 / self.tau) * 0.5 * (neq + neq_opp) - (1.0 / self.tau_minus) * 0.5 * (neq - neq_opp)
+
+
+class TRT_collisionOperator2D(TRT_collisionOperator, BGK_collisionOperator2D):
+    pass
+
+
+class TRT_collisionOperator3D(TRT_collisionOperator, BGK_collisionOperator3D):
+    pass
+
+
+def mrt_matrix_D2Q9(e):
+    #Lallemand & Luo moment basis (rho, e, eps, jx, qx, jy, qy, pxx, pxy), rows are orthogonal
+    cx, cy = e[:, 0].astype(np.float64), e[:, 1].astype(np.float64)
+    c2 = cx**2 + cy**2
+    return np.array([
+        np.ones_like(cx),
+        -4 + 3*c2,
+        4 - 10.5*c2 + 4.5*c2**2,
+        cx,
+        (-5 + 3*c2) * cx,
+        cy,
+        (-5 + 3*c2) * cy,
+        cx**2 - cy**2,
+        cx * cy,
+    ])
+
+def mrt_matrix_D3Q19(e):
+    #d'Humieres et al. (2002) moment basis
+    #(rho, e, eps, jx, qx, jy, qy, jz, qz, 3pxx, 3pixx, pww, piww, pxy, pyz, pxz, mx, my, mz)
+    cx, cy, cz = (e[:, d].astype(np.float64) for d in range(3))
+    c2 = cx**2 + cy**2 + cz**2
+    return np.array([
+        np.ones_like(cx),
+        19*c2 - 30,
+        (21*c2**2 - 53*c2 + 24) / 2,
+        cx,
+        (5*c2 - 9) * cx,
+        cy,
+        (5*c2 - 9) * cy,
+        cz,
+        (5*c2 - 9) * cz,
+        3*cx**2 - c2,
+        (3*c2 - 5) * (3*cx**2 - c2),
+        cy**2 - cz**2,
+        (3*c2 - 5) * (cy**2 - cz**2),
+        cx * cy,
+        cy * cz,
+        cx * cz,
+        (cy**2 - cz**2) * cx,
+        (cz**2 - cx**2) * cy,
+        (cx**2 - cy**2) * cz,
+    ])
+
+
+class MRT_collisionOperator(CollisionOperator):
+    """ Multiple relaxation time operator: f - feq is transformed into moment space (M), every moment relaxes with
+    its own rate (S) and is transformed back, so per cell f -= K (f - feq) with K = M^-1 S M.
+    The shear moments relax with 1/tau (same viscosity as BGK), the conserved ones too (they are zero anyway),
+    the free rates of the non-hydrodynamic moments damp the oscillations that make BGK blow up for tau close to 1/2 """
+    def __init__(self, tau):
+        self.tau = tau
+        self._K = None
+        self._K_key = None
+
+    def collision_matrix(self, descriptor):
+        #K only changes with tau, keep the last one
+        key = (self.tau, id(descriptor))
+        if self._K_key != key:
+            M = self.moment_matrix(descriptor.e)
+            S = np.diag(self.relaxation_rates(1.0 / self.tau))
+            self._K = np.ascontiguousarray(np.linalg.inv(M) @ S @ M)
+            self._K_key = key
+        return self._K
+
+    def relaxation(self, descriptor):
+        omega = 1.0 / self.tau
+        return (MODEL_MRT, omega, omega, self.collision_matrix(descriptor), np.asarray(descriptor.opp, dtype=np.int64))
+
+    def compute_delta_f(self, descriptor, f_lattice, rho, u, mask=None):
+        neq = f_lattice - self.compute_feq(descriptor, rho, u, mask)
+        return -neq @ self.collision_matrix(descriptor).T
+
+
+class MRT_collisionOperator2D(MRT_collisionOperator, BGK_collisionOperator2D):
+    #D2Q9, default rates from Lallemand & Luo (2000)
+    def __init__(self, tau, s_e=1.64, s_eps=1.54, s_q=1.9):
+        super().__init__(tau)
+        self.s_e, self.s_eps, self.s_q = s_e, s_eps, s_q
+
+    def moment_matrix(self, e):
+        return mrt_matrix_D2Q9(e)
+
+    def relaxation_rates(self, omega):
+        return np.array([omega, self.s_e, self.s_eps, omega, self.s_q, omega, self.s_q, omega, omega])
+
+
+class MRT_collisionOperator3D(MRT_collisionOperator, BGK_collisionOperator3D):
+    #D3Q19, default rates from d'Humieres et al. (2002)
+    def __init__(self, tau, s_e=1.19, s_eps=1.4, s_q=1.2, s_pi=1.4, s_m=1.98):
+        super().__init__(tau)
+        self.s_e, self.s_eps, self.s_q, self.s_pi, self.s_m = s_e, s_eps, s_q, s_pi, s_m
+
+    def moment_matrix(self, e):
+        return mrt_matrix_D3Q19(e)
+
+    def relaxation_rates(self, omega):
+        return np.array([
+            omega, self.s_e, self.s_eps,
+            omega, self.s_q, omega, self.s_q, omega, self.s_q,
+            omega, self.s_pi, omega, self.s_pi,
+            omega, omega, omega,
+            self.s_m, self.s_m, self.s_m,
+        ])
@@ -11,6 +11,7 @@ class D2Q9:
                   [1, 1], [-1, 1], [-1, -1], [1, -1]]) #discretized velocity set
     w = np.array([4/9] + [1/9]*4 + [1/36]*4) #weights (is this correct? I hope so)
     opp = [0, 3, 4, 1, 2, 7, 8, 5, 6] #opposite directions for easier calculations
+    cs2 = 1/3 #speed of sound squared
 
 import numpy as np
 
@@ -63,3 +64,29 @@ class D3Q19:
         13, 14,11,12,
         17, 18,15,16
     ]
+
+    #speed of sound squared
+    cs2 = 1/3
+
+
+class D3Q7:
+    # Compact 3D descriptor for scalar transport (advection-diffusion), the scalar only needs
+    # the rest direction and the 6 faces, so it uses a third of the memory of D3Q19
+    Q = 7
+
+    e = np.array([
+        [ 0,  0,  0],
+        [ 1,  0,  0],
+        [-1,  0,  0],
+        [ 0,  1,  0],
+        [ 0, -1,  0],
+        [ 0,  0,  1],
+        [ 0,  0, -1],
+    ])
+
+    #weights, these give cs^2 = 1/4 (the diffusivity is cs2 * (tau - 1/2))
+    w = np.array([1/4] + [1/8]*6)
+
+    opp = [0, 2, 1, 4, 3, 6, 5]
+
+    cs2 = 1/4
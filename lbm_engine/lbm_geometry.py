@@ -1,6 +1,12 @@
+import os
+import json
+import hashlib
+from contextlib import contextmanager
 import numpy as np
+from numba import njit, prange
 import vtk
 from vtk.util.numpy_support import vtk_to_numpy
+from lbm_engine.lbm_descriptors import D3Q19
 
 """ This file contains some geometry helper methods to create geometry masks
 In the Future i want to read geometry information from image data but atm  
@@ -42,50 +48,284 @@ def load_mask_from_vti(filename, field_name="mask"):
     return np.transpose(arr, (2, 1, 0)) 
 
 
+RAW_EXTENSIONS = (".raw", ".bin", ".dat", ".vol")
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+@contextmanager
+def _open_volume(source, shape, dtype, offset, field_name):
+    """ Gives the (nz, ny, nx) shape of a volume and a function reading the planes [z0, z1) of it, use it with `with`
+    so open files are closed again.
+    source is a raw file (needs shape=(nx, ny, nz) and dtype), a (multi page) tiff, a directory/list of tiff
+    slices or a vti file. raw files are memory mapped and tiffs read page by page. The vti reader always loads
+    the whole image, but its array is used without copies (no reshape/transpose of the data) """
+    if isinstance(source, (list, tuple)) or os.path.isdir(source):
+        import tifffile
+        files = sorted(source) if isinstance(source, (list, tuple)) else sorted(
+            os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(TIFF_EXTENSIONS))
+        ny, nx = tifffile.imread(files[0]).shape[:2]
+        def read(z0, z1):
+            return np.stack([tifffile.imread(name) for name in files[z0:z1]])
+        yield (len(files), ny, nx), read
+        return
+
+    extension = os.path.splitext(source)[1].lower()
+    if extension in RAW_EXTENSIONS:
+        if shape is None:
+            raise ValueError("Loading a raw volume needs its shape=(nx, ny, nz)")
+        nx, ny, nz = shape
+        volume = np.memmap(source, dtype=dtype, mode="r", offset=offset, shape=(nz, ny, nx))
+        yield volume.shape, lambda z0, z1: volume[z0:z1]
+        return
+
+    if extension in TIFF_EXTENSIONS:
+        import tifffile
+        with tifffile.TiffFile(source) as tif:
+            ny, nx = tif.pages[0].shape[:2]
+            def read(z0, z1):
+                return np.stack([tif.pages[z].asarray() for z in range(z0, z1)])
+            yield (len(tif.pages), ny, nx), read
+        return
+
+    if extension == ".vti":
+        reader = vtk.vtkXMLImageDataReader()
+        reader.SetFileName(source)
+        reader.Update()
+        data = reader.GetOutput()
+        pd = data.GetPointData()
+        array = pd.GetArray(field_name) if field_name is not None else pd.GetArray(0)
+        if array is None:
+            raise ValueError(f"Field '{field_name}' not found")
+        flat = vtk_to_numpy(array)
+        flat = flat[:, 0] if flat.ndim == 2 else flat
+        nx, ny, nz = data.GetDimensions()
+        #vtk stores x fastest, so this is (z, y, x) already and just a view
+        volume = flat.reshape(nz, ny, nx)
+        #keep the reader alive, the numpy array points into its memory
+        yield volume.shape, lambda z0, z1, _reader=reader: volume[z0:z1]
+        return
+
+    raise ValueError(f"Don't know how to read '{source}'")
+
+
+def _source_hash(source, settings):
+    """ Cache key from the loader settings and path, size and modification time of the input file(s) (all slices
+    for a tiff stack). Only the file stats are read, so a warm cache doesn't touch the volume. Rewriting a file
+    in place with the same size and mtime won't be noticed, delete the cache file then """
+    files = [source] if not (isinstance(source, (list, tuple)) or os.path.isdir(source)) else (
+        sorted(source) if isinstance(source, (list, tuple)) else
+        sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(TIFF_EXTENSIONS)))
+    digest = hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=16)
+    for name in files:
+        stat = os.stat(name)
+        digest.update(json.dumps([os.path.abspath(name), stat.st_size, stat.st_mtime_ns]).encode())
+    return digest.hexdigest()
+
+
+def load_solid_mask(source, threshold=0, invert=False, crop=None, stride=1, reduce="pick", packed=False,
+                    shape=None, dtype=np.uint8, offset=0, field_name=None, chunk=64, cache_dir=None):
+    """ Chunked geometry loader for large (micro CT) volumes, see _open_volume for the supported sources.
+    The volume is read chunk planes at a time, thresholded on the fly (solid = value > threshold, invert flips it),
+    cut to crop=((x0, x1), (y0, y1), (z0, z1)) and downsampled by stride: reduce="pick" takes every stride-th voxel,
+    "majority" makes a coarse voxel solid if at least half of its stride^3 block is (blocks that don't fit at
+    the end are dropped). Only one chunk of the input is in memory at a time.
+    Returns a uint8 mask in lattice (z, y, x) order (addOperator takes it as it is, it converts masks to bool),
+    or with packed=True a bit packed mask along x (8 voxels per byte, see unpack_mask). With cache_dir the result
+    is written to a .npy file named after a hash of the settings and path, size and mtime of the input file(s),
+    the next call with the same input just memory maps it """
+    if reduce not in ("pick", "majority"):
+        raise ValueError(f"reduce has to be 'pick' or 'majority', got '{reduce}'")
+    settings = {"threshold": threshold, "invert": invert, "crop": crop, "stride": stride, "reduce": reduce,
+                "packed": packed, "shape": shape, "dtype": np.dtype(dtype).str, "offset": offset, "field_name": field_name}
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"mask_{_source_hash(source, settings)}.npy")
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode="r")
+
+    with _open_volume(source, shape, dtype, offset, field_name) as ((nz, ny, nx), read):
+        (x0, x1), (y0, y1), (z0, z1) = [(0, n) if c is None else (max(c[0], 0), min(c[1], n))
+                                        for c, n in zip(crop or (None, None, None), (nx, ny, nz))]
+        if reduce == "majority":
+            #only whole blocks
+            x1, y1, z1 = x0 + (x1 - x0) // stride * stride, y0 + (y1 - y0) // stride * stride, z0 + (z1 - z0) // stride * stride
+        out_shape = [-(-(z1 - z0) // stride), -(-(y1 - y0) // stride), -(-(x1 - x0) // stride)]
+        if packed:
+            out_shape[2] = -(-out_shape[2] // 8)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            #write into the cache file directly, so the mask never has to fit into memory twice
+            mask = np.lib.format.open_memmap(cache_file + ".part", mode="w+", dtype=np.uint8, shape=tuple(out_shape))
+        else:
+            mask = np.empty(out_shape, dtype=np.uint8)
+
+        #chunks start on block borders
+        planes = max(chunk // stride, 1) * stride
+        for start in range(z0, z1, planes):
+            stop = min(start + planes, z1)
+            block = read(start, stop)[:, y0:y1, x0:x1]
+            solid = (block > threshold) != invert
+            if reduce == "pick":
+                solid = solid[::stride, ::stride, ::stride]
+            else:
+                cz, cy, cx = solid.shape
+                solid = solid.reshape(cz // stride, stride, cy // stride, stride, cx // stride, stride).sum(axis=(1, 3, 5)) * 2 >= stride**3
+            k = (start - z0) // stride
+            mask[k:k + solid.shape[0]] = np.packbits(solid, axis=2) if packed else solid
+
+    if cache_dir is not None:
+        mask.flush()
+        del mask
+        os.replace(cache_file + ".part", cache_file)
+        return np.load(cache_file, mmap_mode="r")
+    return mask
+
+
+def unpack_mask(packed, nx):
+    #bit packed mask from load_solid_mask(packed=True) back to a bool (z, y, x) mask with nx cells along x
+    return np.unpackbits(packed, axis=2, count=nx).astype(bool)
+
+
+@njit
+def flood_fill(fluid, seeds, e, periodic, queue):
+    #marks every fluid cell connected to the seed cells (flat indices) through the lattice directions e,
+    #queue is scratch for fluid.size flat indices (int32 is enough below 2^31 cells)
+    nx, ny, nz = fluid.shape
+    reached = np.zeros(fluid.shape, dtype=np.uint8)
+    head, tail = 0, 0
+    for seed in seeds:
+        x, y, z = seed // (ny * nz), (seed // nz) % ny, seed % nz
+        if fluid[x, y, z] and not reached[x, y, z]:
+            reached[x, y, z] = 1
+            queue[tail] = seed
+            tail += 1
+    while head < tail:
+        cell = queue[head]
+        head += 1
+        x, y, z = cell // (ny * nz), (cell // nz) % ny, cell % nz
+        for i in range(e.shape[0]):
+            xn, yn, zn = x + e[i, 0], y + e[i, 1], z + e[i, 2]
+            if periodic[0]:
+                xn %= nx
+            if periodic[1]:
+                yn %= ny
+            if periodic[2]:
+                zn %= nz
+            if xn < 0 or xn >= nx or yn < 0 or yn >= ny or zn < 0 or zn >= nz:
+                continue
+            if fluid[xn, yn, zn] and not reached[xn, yn, zn]:
+                reached[xn, yn, zn] = 1
+                queue[tail] = (xn * ny + yn) * nz + zn
+                tail += 1
+    return reached
+
+
+@njit(parallel=True)
+def solid_boundary(solid, e, periodic):
+    #solid cells with at least one fluid neighbour along the lattice directions
+    nx, ny, nz = solid.shape
+    boundary = np.zeros(solid.shape, dtype=np.uint8)
+    for x in prange(nx):
+        for y in range(ny):
+            for z in range(nz):
+                if not solid[x, y, z]:
+                    continue
+                for i in range(e.shape[0]):
+                    xn, yn, zn = x + e[i, 0], y + e[i, 1], z + e[i, 2]
+                    if periodic[0]:
+                        xn %= nx
+                    if periodic[1]:
+                        yn %= ny
+                    if periodic[2]:
+                        zn %= nz
+                    if 0 <= xn < nx and 0 <= yn < ny and 0 <= zn < nz and not solid[xn, yn, zn]:
+                        boundary[x, y, z] = 1
+                        break
+    return boundary
+
+
+def prune_geometry(solid, axis, periodic=(True, True, True), descriptor=None, cache_dir=None):
+    """ Preprocessing of a porous solid mask (bool/uint8, e.g. from load_mask_from_vti or load_solid_mask).
+    The fluid is flood filled along the lattice directions (D3Q19 by default) from the inlet plane (index 0 of
+    array axis `axis`) and from the outlet plane (last index), only fluid reached from both percolates.
+    Everything else (isolated pores, dead end clusters that only touch one side) is turned into solid.
+    axis is the array axis of the mask as it is passed in, so it depends on where the mask comes from:
+    flow along x is axis=0 for (x, y, z) masks (meshgrid, load_mask_from_vti) and axis=2 for the (z, y, x)
+    masks of load_solid_mask. periodic is given per array axis too (the flow axis is never treated as periodic).
+    Returns a dict with the pruned "solid", the percolating "fluid", the "boundary" solid cells next to that fluid
+    and the "interior" solid cells without any fluid neighbour, all in the orientation of the input, plus "porosity"
+    before and after. With cache_dir the result is stored under a hash of the mask and the settings.
+    Use the pruned solid as solid_mask of SparseLattice3D, there only the percolating cells are stored and
+    streamed and the result on them is exactly the same as with the unpruned mask. Lattice3D streams and collides
+    inside the solid too, so BounceBack3D still needs the whole pruned solid there, not just the boundary """
+    solid = np.ascontiguousarray(solid, dtype=bool)
+    e = np.ascontiguousarray((D3Q19() if descriptor is None else descriptor).e[:, :3], dtype=np.int64)
+    e = e[np.any(e != 0, axis=1)]
+    periodic = np.array([p and a != axis for a, p in enumerate(periodic)], dtype=np.bool_)
+
+    if cache_dir is not None:
+        digest = hashlib.blake2b(np.packbits(solid).tobytes(), digest_size=16)
+        digest.update(json.dumps({"shape": solid.shape, "axis": axis, "periodic": periodic.tolist(), "e": e.tolist()}).encode())
+        cache_file = os.path.join(cache_dir, f"pruned_{digest.hexdigest()}.npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return _pruned_result(solid, cached["solid"].astype(bool), cached["boundary"].astype(bool))
+
+    fluid = ~solid
+    #flat indices of the fluid cells on the in- and outlet plane, computed from the plane coordinates only
+    seeds = []
+    for position in (0, solid.shape[axis] - 1):
+        coordinates = list(np.nonzero(np.take(fluid, position, axis=axis)))
+        coordinates.insert(axis, np.full(coordinates[0].shape, position))
+        seeds.append(np.ravel_multi_index(coordinates, solid.shape))
+    #both fills run one after another, so they can share the queue
+    queue = np.empty(solid.size, dtype=np.int32 if solid.size < 2**31 else np.int64)
+    percolating = (flood_fill(fluid, seeds[0], e, periodic, queue) & flood_fill(fluid, seeds[1], e, periodic, queue)).astype(bool)
+
+    pruned = ~percolating
+    boundary = solid_boundary(pruned, e, periodic).astype(bool)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_file, solid=pruned, boundary=boundary)
+    return _pruned_result(solid, pruned, boundary)
+
+
+def _pruned_result(original, solid, boundary):
+    return {
+        "solid": solid,
+        "fluid": ~solid,
+        "boundary": boundary,
+        "interior": solid & ~boundary,
+        "porosity": 1.0 - original.mean(),
+        "pruned_porosity": 1.0 - solid.mean(),
+    }
+
+
 def create_triangle_mask(X, Y, center_x, center_y, base_width, height, direction='right'):
-    mask = np.zeros_like(X, dtype=bool)
-
-    if direction == 'right':
-        x0 = center_x - base_width // 2
-        x1 = center_x + height
-        y0 = center_y - base_width // 2
-        y1 = center_y + base_width // 2
-
-        for i in range(X.shape[0]):
-            for j in range(X.shape[1]):
-                x, y = X[i, j], Y[i, j]
-                if x0 <= x <= x1:
-                    y_rel = (y - center_y) / (base_width / 2)
-                    x_rel = (x - x0) / (x1 - x0)
-                    if abs(y_rel) <= 1 - x_rel:
-                        mask[i, j] = True
-
-    elif direction == 'left':
-        x0 = center_x + base_width // 2
-        x1 = center_x - height
-        y0 = center_y - base_width // 2
-        y1 = center_y + base_width // 2
-
-        for i in range(X.shape[0]):
-            for j in range(X.shape[1]):
-                x, y = X[i, j], Y[i, j]
-                if x1 <= x <= x0:
-                    y_rel = (y - center_y) / (base_width / 2)
-                    x_rel = (x0 - x) / (x0 - x1)
-                    if abs(y_rel) <= 1 - x_rel:
-                        mask[i, j] = True
+    #same test as before, just on the whole arrays at once instead of a python loop over every cell
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y_rel = np.abs((Y - center_y) / (base_width / 2))
+        if direction == 'right':
+            x0 = center_x - base_width // 2
+            x1 = center_x + height
+            mask = (x0 <= X) & (X <= x1) & (y_rel <= 1 - (X - x0) / (x1 - x0))
+        elif direction == 'left':
+            x0 = center_x + base_width // 2
+            x1 = center_x - height
+            mask = (x1 <= X) & (X <= x0) & (y_rel <= 1 - (x0 - X) / (x0 - x1))
+        else:
+            mask = np.zeros(np.broadcast_shapes(np.shape(X), np.shape(Y)), dtype=bool)
 
     return mask
 
 def create_rectangle_mask(X, Y, center_x, center_y, width, height):
-    mask = np.zeros_like(X, dtype=bool)
-
+    #X, Y can be full meshgrids, the lattice.X/Y views or the open grids of lattice.grid(sparse=True)
     x0 = center_x - width // 2
     x1 = center_x + width // 2
     y0 = center_y - height // 2
     y1 = center_y + height // 2
 
-    mask[(X >= x0) & (X <= x1) & (Y >= y0) & (Y <= y1)] = True
+    mask = (X >= x0) & (X <= x1) & (Y >= y0) & (Y <= y1)
 
     return mask
 
@@ -93,3 +333,99 @@ def create_circle_mask(X, Y, center_x, center_y, radius):
     dist_squared = (X - center_x)**2 + (Y - center_y)**2
     mask = dist_squared <= radius**2
     return mask
+
+
+""" Rasterizers that don't need meshgrid arrays: shape is the mask shape in the (x, y) / (x, y, z) order of the
+meshgrid(..., indexing="ij") masks above, every primitive only computes its bounding box (with open ogrid
+coordinates, so not even the box gets full coordinate arrays) and paints value into out.
+CSG works by painting into the same mask: True adds (union), False cuts out (difference), e.g.
+    mask = box_mask((nx, ny, nz), (10, 10, 10), (50, 50, 50))
+    sphere_mask(mask.shape, (30, 30, 30), 15, out=mask, value=False)
+union/intersection/difference combine finished masks in place """
+
+def _paint(shape, lo, hi, out, value, inside):
+    #clips the box [lo, hi] to the domain and sets out[box][inside(*coordinates)] = value
+    if out is None:
+        out = np.zeros(shape, dtype=bool)
+    lo = [max(int(np.floor(v)), 0) for v in lo]
+    hi = [min(int(np.ceil(v)), n - 1) for v, n in zip(hi, shape)]
+    if any(start > stop for start, stop in zip(lo, hi)):
+        return out
+    box = tuple(slice(start, stop + 1) for start, stop in zip(lo, hi))
+    coordinates = np.ogrid[box]
+    out[box][inside(*coordinates)] = value
+    return out
+
+
+def box_mask(shape, lo, hi, out=None, value=True):
+    #all cells with lo <= x <= hi in every direction (like create_rectangle_mask)
+    def inside(*coordinates):
+        #_paint rounds the box outward, fractional bounds need the real test
+        result = np.ones(np.broadcast_shapes(*(x.shape for x in coordinates)), dtype=bool)
+        for x, start, stop in zip(coordinates, lo, hi):
+            result &= (x >= start) & (x <= stop)
+        return result
+    return _paint(shape, lo, hi, out, value, inside)
+
+
+def sphere_mask(shape, center, radius, out=None, value=True):
+    #disk in 2D, sphere in 3D, cells with |x - center| <= radius (like create_circle_mask)
+    def inside(*coordinates):
+        dist_squared = sum((x - c)**2 for x, c in zip(coordinates, center))
+        return dist_squared <= radius**2
+    return _paint(shape, [c - radius for c in center], [c + radius for c in center], out, value, inside)
+
+
+def cylinder_mask(shape, center, radius, axis=2, extent=None, out=None, value=True):
+    """ 3D cylinder along axis (0 = x, 1 = y, 2 = z), center are the two other coordinates,
+    extent = (start, stop) along the axis (inclusive, default the whole domain) """
+    other = [a for a in range(3) if a != axis]
+    start, stop = (0, shape[axis] - 1) if extent is None else extent
+    lo, hi = [0.0] * 3, [0.0] * 3
+    for a, c in zip(other, center):
+        lo[a], hi[a] = c - radius, c + radius
+    lo[axis], hi[axis] = start, stop
+    def inside(*coordinates):
+        dist_squared = sum((coordinates[a] - c)**2 for a, c in zip(other, center))
+        return np.broadcast_to(dist_squared <= radius**2, np.broadcast_shapes(*(x.shape for x in coordinates)))
+    return _paint(shape, lo, hi, out, value, inside)
+
+
+def polygon_mask(shape, vertices, out=None, value=True):
+    """ 2D polygon given by its (x, y) vertices, cells inside by the even-odd rule. The ray casting is
+    vectorized over the bounding box, the python loop only runs over the edges """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    def inside(X, Y):
+        result = np.zeros(np.broadcast_shapes(X.shape, Y.shape), dtype=bool)
+        for (xa, ya), (xb, yb) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            if ya == yb:
+                continue
+            crosses = (ya > Y) != (yb > Y)
+            x_cross = xa + (Y - ya) * (xb - xa) / (yb - ya)
+            result ^= crosses & (X < x_cross)
+        return result
+    return _paint(shape, vertices.min(axis=0), vertices.max(axis=0), out, value, inside)
+
+
+def triangle_mask(shape, a, b, c, out=None, value=True):
+    #triangle from its three (x, y) corners
+    return polygon_mask(shape, (a, b, c), out, value)
+
+
+def union(mask, *masks):
+    #all these work in place on the first mask and return it
+    for other in masks:
+        np.logical_or(mask, other, out=mask)
+    return mask
+
+
+def intersection(mask, *masks):
+    for other in masks:
+        np.logical_and(mask, other, out=mask)
+    return mask
+
+
+def difference(mask, *masks):
+    for other in masks:
+        mask[other] = False
+    return mask
@@ -0,0 +1,232 @@
+import os
+import json
+import zlib
+import numpy as np
+
+""" This file contains a small native snapshot format for the lattice fields (rho, u, phi, ...). Compared to the VTI
+export it writes the fields in the (z, y, x) order of the lattice without any transposed copies, can store them as
+float32/float16 and optionally zlib compressed, and a single plane can be read without loading the whole file.
+
+Layout of a .lbs file:
+    b"L4TTSNAP" | uint32 header length | json header | padding to 64 bytes | field data
+Every field is cut into chunks of `chunk` planes along the first axis (z in 3D, y in 2D), every chunk is stored
+on its own (compressed or raw) and the header keeps the offset and size of all chunks. Uncompressed fields are
+one contiguous block and get opened as np.memmap. snapshot_to_vti converts a snapshot for ParaView.
+The same format is used for the checkpoints (write_checkpoint/read_checkpoint, called by the save_checkpoint
+and load_checkpoint methods of the lattices) """
+
+MAGIC = b"L4TTSNAP"
+ALIGN = 64
+COMPRESSIONS = (None, "zlib")
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_snapshot(filename, fields, t=0, dtype=None, compression=None, chunk=16, level=1, ndim=None, attrs=None):
+    """ Writes a dict of arrays (all with the same leading shape, e.g. rho (nz, ny, nx) and u (nz, ny, nx, 3))
+    into filename. dtype (e.g. np.float16/np.float32) converts the fields chunk by chunk while writing, without it
+    and without compression the arrays are written straight from their buffers. ndim is the lattice dimension
+    (2 or 3) for the VTI converter, by default the smallest ndim of the fields. attrs is an optional json-able
+    dict that is kept in the header (used by the checkpoints) """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression has to be one of {COMPRESSIONS}, got {compression}")
+
+    #the header needs the chunk sizes, compressed chunks are made first and kept until the header is written
+    entries, blocks = {}, []
+    offset = 0
+    for name, array in fields.items():
+        array = np.asarray(array)
+        out_dtype = np.dtype(dtype) if dtype is not None else array.dtype
+        n = array.shape[0]
+        chunks = []
+        for start in range(0, n, chunk):
+            part = array[start:start + chunk]
+            if part.dtype != out_dtype or not part.flags.c_contiguous:
+                part = np.ascontiguousarray(part, dtype=out_dtype)
+            data = memoryview(part).cast("B") if compression is None else zlib.compress(part, level)
+            chunks.append([offset, len(data)])
+            blocks.append(data)
+            offset += len(data)
+        entries[name] = {"dtype": out_dtype.str, "shape": list(array.shape), "chunk": chunk, "chunks": chunks}
+        #next field starts aligned so memmap offsets stay aligned
+        padding = _aligned(offset) - offset
+        if padding:
+            blocks.append(b"\0" * padding)
+            offset += padding
+
+    ndim = min(len(entry["shape"]) for entry in entries.values()) if ndim is None else ndim
+    header = json.dumps({"version": 1, "t": int(t), "ndim": ndim, "compression": compression, "fields": entries,
+                         "attrs": {} if attrs is None else attrs}).encode()
+    data_start = _aligned(len(MAGIC) + 4 + len(header))
+
+    with open(filename, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint32(len(header)).tobytes())
+        file.write(header)
+        file.write(b"\0" * (data_start - len(MAGIC) - 4 - len(header)))
+        for block in blocks:
+            file.write(block)
+
+
+def save_snapshot(filename, lattice, fields=None, **kwargs):
+    #fields of a lattice by attribute name, default rho and u (and phi on scalar/coupled lattices)
+    if fields is None:
+        fields = [name for name in ("rho", "u", "phi") if hasattr(lattice, name)]
+    ndim = 3 if hasattr(lattice, "nz") else 2
+    write_snapshot(filename, {name: getattr(lattice, name) for name in fields}, t=getattr(lattice, "t", 0), ndim=ndim, **kwargs)
+
+
+class Snapshot:
+    """ Read access to a .lbs file. snapshot["u"] gives the whole field (a read only np.memmap for uncompressed
+    files, nothing is loaded until it is used), planes(name, start, stop) only reads/decompresses the chunks
+    that contain the planes [start, stop) of the first axis """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a snapshot file")
+            length = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+            header = json.loads(file.read(length))
+        self.data_start = _aligned(len(MAGIC) + 4 + length)
+        self.t = header["t"]
+        self.ndim = header["ndim"]
+        self.compression = header["compression"]
+        self.fields = header["fields"]
+        self.attrs = header.get("attrs", {})
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def keys(self):
+        return self.fields.keys()
+
+    def __getitem__(self, name):
+        entry = self.fields[name]
+        if self.compression is None:
+            offset = self.data_start + entry["chunks"][0][0]
+            return np.memmap(self.filename, dtype=np.dtype(entry["dtype"]), mode="r", offset=offset, shape=tuple(entry["shape"]))
+        return self.planes(name, 0, entry["shape"][0])
+
+    def planes(self, name, start, stop):
+        entry = self.fields[name]
+        if self.compression is None:
+            return np.array(self[name][start:stop])
+        dtype, shape, chunk = np.dtype(entry["dtype"]), entry["shape"], entry["chunk"]
+        first, last = start // chunk, (stop - 1) // chunk
+        parts = []
+        with open(self.filename, "rb") as file:
+            for k in range(first, last + 1):
+                offset, size = entry["chunks"][k]
+                file.seek(self.data_start + offset)
+                parts.append(np.frombuffer(zlib.decompress(file.read(size)), dtype=dtype))
+        block = np.concatenate(parts).reshape((-1,) + tuple(shape[1:]))
+        return block[start - first * chunk:stop - first * chunk]
+
+    def plane(self, name, index):
+        return self.planes(name, index, index + 1)[0]
+
+
+def read_snapshot(filename):
+    #all fields of a snapshot as normal arrays
+    snapshot = Snapshot(filename)
+    return {name: np.array(snapshot[name]) for name in snapshot.keys()}, snapshot.t
+
+
+def snapshot_to_vti(filename, output=None):
+    """ Converts a snapshot into a VTI file for ParaView (same layout as export_fields_vti2D/3D),
+    vector fields (last axis 2 or 3) become vectors, everything else point scalars """
+    from pyevtk.hl import imageToVTK
+
+    ndim = Snapshot(filename).ndim
+    fields, _ = read_snapshot(filename)
+    #VTK wants (x, y, z), float16 isn't supported there
+    axes = (2, 1, 0) if ndim == 3 else (1, 0)
+    def to_vtk(array):
+        array = np.transpose(array, axes).astype(np.float32 if array.dtype == np.float16 else array.dtype)
+        return np.ascontiguousarray(array if ndim == 3 else array[:, :, np.newaxis])
+
+    point_data = {}
+    for name, array in fields.items():
+        if array.ndim == ndim + 1:
+            components = [to_vtk(array[..., c]) for c in range(array.shape[-1])]
+            while len(components) < 3:
+                components.append(np.zeros_like(components[0]))
+            point_data[name] = tuple(components)
+        else:
+            point_data[name] = to_vtk(array)
+
+    output = os.path.splitext(filename)[0] if output is None else output
+    imageToVTK(output, origin=(0.0, 0.0, 0.0), spacing=(1.0, 1.0, 1.0), pointData=point_data)
+    return output + ".vti"
+
+
+def _storage(array):
+    #the memory behind a field: soa distributions are a view on a Q-major array, store that one so nothing is copied
+    if not array.flags.c_contiguous:
+        q_major = np.moveaxis(array, -1, 0)
+        if q_major.flags.c_contiguous:
+            return q_major, "q_major"
+    return array, "c"
+
+
+def _operator_state(operators):
+    #the attributes listed in CHECKPOINT_STATE of the operators (e.g. the time counter of PulsedConcentrationDirichlet)
+    return {name: {key: getattr(operator, key) for key in getattr(operator, "CHECKPOINT_STATE", ())}
+            for name, operator in operators.items()}
+
+
+def write_checkpoint(filename, lattice, dtype=None):
+    """ Writes everything a lattice needs to continue bit exact: the fields listed in CHECKPOINT_FIELDS of its class
+    (distributions, rho/u/phi), t, the AA phase and the CHECKPOINT_STATE attributes of the operators (settings like
+    rho_value are not stored, so a restart can change them).
+    dtype=np.float32 makes float64 checkpoints half as big, but then the restart is of course not exact anymore """
+    fields, layouts = {}, {}
+    for name in lattice.CHECKPOINT_FIELDS:
+        fields[name], layouts[name] = _storage(getattr(lattice, name))
+    attrs = {
+        "lattice": type(lattice).__name__,
+        "t": int(lattice.t),
+        "layouts": layouts,
+        "streaming": getattr(lattice, "streaming", None),
+        "aa_phase": int(getattr(lattice, "_aa_phase", 0)),
+        "f_shift": float(getattr(lattice, "f_shift", 0.0)),
+        "operators": _operator_state(lattice.geometry),
+        "scalar_operators": _operator_state(getattr(lattice, "scalar_geometry", {})),
+    }
+    write_snapshot(filename, fields, t=lattice.t, dtype=dtype, attrs=attrs)
+
+
+def read_checkpoint(filename, lattice):
+    """ Restores a checkpoint into a lattice that was set up the same way (same class, size, streaming mode,
+    store_deviation and operator names), the memory layout and dtype may differ """
+    snapshot = Snapshot(filename)
+    attrs = snapshot.attrs
+    if attrs.get("lattice") != type(lattice).__name__:
+        raise ValueError(f"Checkpoint is for a {attrs.get('lattice')}, not a {type(lattice).__name__}")
+    if attrs["streaming"] != getattr(lattice, "streaming", None):
+        raise ValueError(f"Checkpoint was written with streaming='{attrs['streaming']}'")
+    if attrs["f_shift"] != float(getattr(lattice, "f_shift", 0.0)):
+        raise ValueError("Checkpoint and lattice differ in store_deviation")
+
+    for name in lattice.CHECKPOINT_FIELDS:
+        data = snapshot[name]
+        if attrs["layouts"][name] == "q_major":
+            data = np.moveaxis(data, 0, -1)
+        target = getattr(lattice, name)
+        if data.shape != target.shape:
+            raise ValueError(f"Field '{name}' has shape {data.shape} in the checkpoint, the lattice has {target.shape}")
+        target[...] = data
+
+    for key, operators in (("operators", lattice.geometry), ("scalar_operators", getattr(lattice, "scalar_geometry", {}))):
+        for name, state in attrs[key].items():
+            if name not in operators:
+                raise ValueError(f"Checkpoint has an operator '{name}' that was not added to the lattice")
+            for attribute, value in state.items():
+                if attribute in getattr(operators[name], "CHECKPOINT_STATE", ()):
+                    setattr(operators[name], attribute, value)
+
+    lattice.t = attrs["t"]
+    if hasattr(lattice, "_aa_phase"):
+        lattice._aa_phase = attrs["aa_phase"]
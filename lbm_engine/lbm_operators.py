@@ -2,55 +2,145 @@ import numpy as np
 from numba import njit, prange
 
 @njit(parallel=True)
-def bounceback(f, opp, mask):
-    nz, ny, nx, Q = f.shape
-    for i in prange(Q):
-        for z in range(nz):
-            for y in range(ny):
-                for x in range(nx):
-                    if mask[z, y, x]:
-                        f[z, y, x, i] = f[z, y, x, opp[i]]
+def bounceback(f, cells, links, opp):
+    #cells are the (z, y, x) positions inside the mask, links the directions that actually change (see BounceBack3D)
+    for k in prange(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in links:
+            f[z, y, x, i] = f[z, y, x, opp[i]]
 
 
 @njit(parallel=True)
-def apply_velocity_bc(f, u, rho, mask, e, w, u0):
-    nz, ny, nx = mask.shape
+def apply_velocity_bc(f, u, rho, cells, e, w, u0, shift):
     Q = e.shape[0]
+    u2 = u0[0]**2 + u0[1]**2 + u0[2]**2
 
-    for z in prange(nz):
-        for y in range(ny):
-            for x in range(nx):
-                if mask[z, y, x]:
-                    rho[z, y, x] = 1.0
-                    for d in range(3):
-                        u[z, y, x, d] = u0[d]
+    for k in prange(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        rho[z, y, x] = 1.0
+        for d in range(3):
+            u[z, y, x, d] = u0[d]
 
-                    u2 = u0[0]**2 + u0[1]**2 + u0[2]**2
-                    for i in range(Q):
-                        cu = 0.0
-                        for d in range(3):
-                            cu += u0[d] * e[i, d]
-                        feq = w[i] * rho[z, y, x] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
-                        f[z, y, x, i] = feq
+        for i in range(Q):
+            cu = 0.0
+            for d in range(3):
+                cu += u0[d] * e[i, d]
+            feq = w[i] * rho[z, y, x] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
+            f[z, y, x, i] = feq - shift * w[i]
 
 
 @njit(parallel=True)
-def apply_pressure_bc(f, u, rho, mask, e, w, rho0):
-    nz, ny, nx = mask.shape
+def apply_pressure_bc(f, u, rho, cells, e, w, rho0, shift):
     Q = e.shape[0]
 
-    for z in prange(nz):
-        for y in range(ny):
-            for x in range(nx):
-                if mask[z, y, x]:
-                    rho[z, y, x] = rho0
-                    for d in range(3):
-                        u[z, y, x, d] = 0.0
-
-                    for i in range(Q):
-                        feq = w[i] * rho0
-                        f[z, y, x, i] = feq
+    for k in prange(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        rho[z, y, x] = rho0
+        for d in range(3):
+            u[z, y, x, d] = 0.0
+
+        for i in range(Q):
+            feq = w[i] * rho0
+            f[z, y, x, i] = feq - shift * w[i]
+
+
+@njit(parallel=True)
+def apply_velocity_bc_indexed(f, u, rho, cells, e, w, u0, shift):
+    #same as apply_velocity_bc but for a list of cell numbers on a (N, Q) cell list lattice
+    Q = e.shape[0]
+    u2 = u0[0]**2 + u0[1]**2 + u0[2]**2
+    for k in prange(cells.shape[0]):
+        n = cells[k]
+        rho[n] = 1.0
+        for d in range(3):
+            u[n, d] = u0[d]
+        for i in range(Q):
+            cu = 0.0
+            for d in range(3):
+                cu += u0[d] * e[i, d]
+            f[n, i] = w[i] * rho[n] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+
+
+@njit(parallel=True)
+def apply_pressure_bc_indexed(f, u, rho, cells, e, w, rho0, shift):
+    Q = e.shape[0]
+    for k in prange(cells.shape[0]):
+        n = cells[k]
+        rho[n] = rho0
+        for d in range(3):
+            u[n, d] = 0.0
+        for i in range(Q):
+            f[n, i] = w[i] * rho0 - shift * w[i]
+
+
+@njit(parallel=True)
+def apply_scalar_bc(g, u, phi, cells, e, w, inv_cs2, value):
+    #fixed scalar value + advection diffusion equilibrium on the given (z, y, x) cells
+    Q = e.shape[0]
+    for k in prange(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        phi[z, y, x] = value
+        for i in range(Q):
+            cu = u[z, y, x, 0] * e[i, 0] + u[z, y, x, 1] * e[i, 1] + u[z, y, x, 2] * e[i, 2]
+            g[z, y, x, i] = w[i] * value * (1 + inv_cs2 * cu)
+
+
+@njit(parallel=True)
+def apply_zero_gradient(g, u, phi, cells, neighbours, e, w, inv_cs2):
+    #copy phi from the neighbour cells first (they can be boundary cells too), then set the equilibrium
+    Q = e.shape[0]
+    N = cells.shape[0]
+    values = np.empty(N)
+    for k in prange(N):
+        values[k] = phi[neighbours[k, 0], neighbours[k, 1], neighbours[k, 2]]
+    for k in prange(N):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        phi[z, y, x] = values[k]
+        for i in range(Q):
+            cu = u[z, y, x, 0] * e[i, 0] + u[z, y, x, 1] * e[i, 1] + u[z, y, x, 2] * e[i, 2]
+            g[z, y, x, i] = w[i] * values[k] * (1 + inv_cs2 * cu)
+
+
+def bounce_links(opp):
+    #applied in order, f[i] = f[opp[i]] only changes something for i < opp[i] (the second copy of every pair
+    #just writes the value back), the rest direction never changes
+    return np.array([i for i in range(len(opp)) if i < opp[i]], dtype=np.int64)
+
+
+def scalar_equilibrium(e, w, phi, u):
+    #advection diffusion equilibrium for a list of cells, phi (N,) and u (N, 2) -> (N, Q)
+    cu = u[:, 0:1]*e[:, 0] + u[:, 1:2]*e[:, 1]
+    return w * phi[:, None] * (1 + 3*cu)
+
+
 class Operator:
+    #1.0 if the lattice stores f - w_i instead of f (store_deviation), the equilibria we write have to be shifted too
+    shift = 0.0
+    #positions inside the mask as an (N, ndim) index array (and as a tuple for numpy indexing), set by compile_mask
+    cells = None
+    index = None
+    #attributes that change while running (like a time counter) and go into checkpoints, settings are not restored
+    CHECKPOINT_STATE = ()
+
+    def bind(self, lattice):
+        #called by addOperator of the lattice the operator gets added to
+        self.shift = getattr(lattice, "f_shift", 0.0)
+        shape = (lattice.nz, lattice.ny, lattice.nx) if hasattr(lattice, "nz") else (lattice.ny, lattice.nx)
+        self.compile_mask(shape)
+
+    def compile_mask(self, shape):
+        #turn the mask into a list of cells once, so apply only touches the boundary cells and not the whole grid.
+        #masks from meshgrid come in (x, y[, z]), the lattice works in ([z,] y, x)
+        mask = np.asarray(self.mask, dtype=bool)
+        mask = np.transpose(mask) if mask.shape != tuple(shape) else mask
+        self.cells = np.argwhere(mask)
+        self.index = tuple(self.cells.T)
+
+    def _ensure_compiled(self, shape):
+        #operators that were never added to a lattice (apply called by hand) compile on first use
+        if self.cells is None:
+            self.compile_mask(shape)
+
     def apply(self, f, u=None, rho=None):
         pass
 
@@ -58,22 +148,24 @@ class BounceBack2D(Operator):
     def __init__(self, descriptor, mask):
         
         self.opp = descriptor.opp
+        self.links = bounce_links(self.opp)
         self.mask = mask
 
     def apply(self, f, u=None, rho=None):
-        mask = np.transpose(self.mask) if self.mask.shape != f.shape[:2] else self.mask
-        for i in range(len(self.opp)):
-            f[mask, i] = f[mask, self.opp[i]]
+        self._ensure_compiled(f.shape[:2])
+        for i in self.links:
+            f[self.index + (i,)] = f[self.index + (self.opp[i],)]
 
 class BounceBack3D(Operator):
     def __init__(self, descriptor, mask):
         
-        self.opp = descriptor.opp
+        self.opp = np.asarray(descriptor.opp)
+        self.links = bounce_links(self.opp)
         self.mask = mask
 
     def apply(self, f, u=None, rho=None):
-        self.mask = np.transpose(self.mask, (2, 1, 0)) if self.mask.shape != f.shape[:3] else self.mask
-        bounceback(f, self.opp, self.mask)
+        self._ensure_compiled(f.shape[:3])
+        bounceback(f, self.cells, self.links, self.opp)
 
 
 
@@ -88,12 +180,13 @@ class VelocityDirichlet2D(Operator):
         self.velocity_func = velocity_func
 
     def apply(self, f, u, rho):
-        mask = np.transpose(self.mask) if self.mask.shape != f.shape[:2] else self.mask
-        u[mask] = self.velocity_func(u[mask].shape)
-        rho[mask] = 1.0  # assume constant pressure
-        u2 = u[:,:,0]**2 + u[:,:,1]**2
-        feq = self.collisionOperator.compute_feq(self.descriptor, rho, u, mask)
-        f[mask] = feq[mask]
+        self._ensure_compiled(f.shape[:2])
+        index = self.index
+        u[index] = self.velocity_func(u[index].shape)
+        rho[index] = 1.0  # assume constant pressure
+        #equilibrium only for the boundary cells
+        feq = self.collisionOperator.compute_feq(self.descriptor, rho[index], u[index])
+        f[index] = feq - self.shift * self.w
 
 class VelocityDirichlet3D(Operator):
     def __init__(self, descriptor, collisionOperator, mask, velocity_func):
@@ -102,11 +195,18 @@ class VelocityDirichlet3D(Operator):
         self.mask = mask
         self.velocity_func = velocity_func  # returns constant or spatial field
 
+    def compile_mask(self, shape):
+        super().compile_mask(shape)
+        #velocity_func is taken as constant for now, evaluate it once for a single cell instead of the whole grid every step
+        self.u0 = self.velocity_func((1, 1, 1, 3))[0, 0, 0]
+
     def apply(self, f, u, rho):
-        self.mask = np.transpose(self.mask, (2, 1, 0)) if self.mask.shape != f.shape[:3] else self.mask
-        target_shape = (*self.mask.shape, 3)
-        u0 = self.velocity_func(target_shape)[0, 0, 0]  # assumes constant for now
-        apply_velocity_bc(f, u, rho, self.mask, self.e, self.w, u0)
+        self._ensure_compiled(f.shape[:3])
+        apply_velocity_bc(f, u, rho, self.cells, self.e, self.w, self.u0, self.shift)
+
+    def apply_indexed(self, f, u, rho, cells):
+        # used by SparseLattice3D, cells are the fluid cell numbers inside the mask
+        apply_velocity_bc_indexed(f, u, rho, cells, self.e, self.w, self.u0, self.shift)
 
 
 class PressureDirichlet3D(Operator):
@@ -117,8 +217,11 @@ class PressureDirichlet3D(Operator):
         self.rho_value = rho_value
 
     def apply(self, f, u, rho):
-        self.mask = np.transpose(self.mask, (2, 1, 0)) if self.mask.shape != f.shape[:3] else self.mask
-        apply_pressure_bc(f, u, rho, self.mask, self.e, self.w, self.rho_value)
+        self._ensure_compiled(f.shape[:3])
+        apply_pressure_bc(f, u, rho, self.cells, self.e, self.w, self.rho_value, self.shift)
+
+    def apply_indexed(self, f, u, rho, cells):
+        apply_pressure_bc_indexed(f, u, rho, cells, self.e, self.w, self.rho_value, self.shift)
 
 
 
@@ -133,17 +236,19 @@ class PressureDirichlet2D(Operator):
         self.rho_value = rho_value
 
     def apply(self, f, u, rho):
-        mask = np.transpose(self.mask) if self.mask.shape != f.shape[:2] else self.mask
-        rho[mask] = self.rho_value
-        u[mask, :] = 0.0
-        u2 = u[:,:,0]**2 + u[:,:,1]**2
-        feq = self.collisionOperator.compute_feq(self.descriptor, rho, u, mask)
-        f[mask] = feq[mask]
+        self._ensure_compiled(f.shape[:2])
+        index = self.index
+        rho[index] = self.rho_value
+        u[index] = 0.0
+        feq = self.collisionOperator.compute_feq(self.descriptor, rho[index], u[index])
+        f[index] = feq - self.shift * self.w
 
 
 #########
 
-class PulsedConcentrationDirichlet:
+class PulsedConcentrationDirichlet(Operator):
+    CHECKPOINT_STATE = ("t",)
+
     def __init__(self, descriptor, mask, base_value, pulse_value, t_start=0, t_end=None, sharpness=10.0):
         self.e = descriptor.e
         self.w = descriptor.w
@@ -157,7 +262,8 @@ class PulsedConcentrationDirichlet:
         self.sharpness = sharpness
 
     def apply(self, g, u, phi):
-        mask = np.transpose(self.mask) if self.mask.shape != phi.shape else self.mask
+        self._ensure_compiled(phi.shape)
+        index = self.index
 
         # Smooth pulse using tanh
         if self.t_start <= self.t <= self.t_end:
@@ -165,16 +271,13 @@ class PulsedConcentrationDirichlet:
         else:
             value = self.base_value
 
-        phi[mask] = value
+        phi[index] = value
 
-        for i in range(self.Q):
-            cu = u[:, :, 0]*self.e[i, 0] + u[:, :, 1]*self.e[i, 1]
-            geq = self.w[i] * phi * (1 + 3*cu)
-            g[mask, i] = geq[mask]
+        g[index] = scalar_equilibrium(self.e, self.w, phi[index], u[index])
         #print(str(self.t) +" ww "+str(self.t_end)+ " ww " +str(value))
         self.t += 1
 
-class ConstantScalarDirichlet:
+class ConstantScalarDirichlet(Operator):
     def __init__(self, descriptor, mask, value):
         self.e = descriptor.e
         self.w = descriptor.w
@@ -183,37 +286,70 @@ class ConstantScalarDirichlet:
         self.value = value
 
     def apply(self, g, u, phi):
-        mask = self.mask
-        if mask.shape != phi.shape:
-            mask = mask.T
+        self._ensure_compiled(phi.shape)
+        index = self.index
 
         # Set scalar field
-        phi[mask] = self.value
+        phi[index] = self.value
 
         # Compute equilibrium and update distribution
-        for i in range(self.Q):
-            cu = u[:, :, 0] * self.e[i, 0] + u[:, :, 1] * self.e[i, 1]
-            geq = self.w[i] * phi * (1 + 3 * cu)
-            g[mask, i] = geq[mask]
+        g[index] = scalar_equilibrium(self.e, self.w, phi[index], u[index])
 
 
-class ZeroGradientOutlet:
+class ZeroGradientOutlet(Operator):
     def __init__(self, descriptor, mask):
         self.e = descriptor.e
         self.w = descriptor.w
         self.Q = descriptor.Q
         self.mask = mask
 
+    def compile_mask(self, shape):
+        super().compile_mask(shape)
+        #the right neighbour (x + 1, periodic) of every boundary cell
+        y, x = self.index
+        self.neighbour_index = (y, (x + 1) % shape[1])
+
     def apply(self, g, u, phi):
         # Neumann boundary -> Boundary cell has to be the same value as the neighboring cell (is this cheating? Idk but it seems to work)
-        mask = np.transpose(self.mask) if self.mask.shape != phi.shape else self.mask
+        self._ensure_compiled(phi.shape)
+        index = self.index
 
-        # Buffer our scalar value to apply our neighbors phi
-        shifted_phi = np.roll(phi, shift=-1, axis=1)
-        phi[mask] = shifted_phi[mask]
+        # Copy over our neighbors phi
+        phi[index] = phi[self.neighbour_index]
 
         # Compute equilibrium and update distribution
-        for i in range(self.Q):
-            cu = u[:, :, 0]*self.e[i, 0] + u[:, :, 1]*self.e[i, 1]
-            geq = self.w[i] * phi * (1 + 3*cu)
-            g[mask, i] = geq[mask]
\ No newline at end of file
+        g[index] = scalar_equilibrium(self.e, self.w, phi[index], u[index])
+
+
+class ConstantScalarDirichlet3D(Operator):
+    #3D version of ConstantScalarDirichlet for ScalarLattice3D
+    def __init__(self, descriptor, mask, value):
+        self.e = descriptor.e
+        self.w = descriptor.w
+        self.inv_cs2 = 1.0 / descriptor.cs2
+        self.mask = mask
+        self.value = value
+
+    def apply(self, g, u, phi):
+        self._ensure_compiled(phi.shape)
+        apply_scalar_bc(g, u, phi, self.cells, self.e, self.w, self.inv_cs2, self.value)
+
+
+class ZeroGradientOutlet3D(Operator):
+    #3D version of ZeroGradientOutlet, direction is the (dx, dy, dz) offset of the cell phi gets copied from.
+    #The default takes the cell at x - 1, so it fits an outlet on the +x side of the domain
+    def __init__(self, descriptor, mask, direction=(-1, 0, 0)):
+        self.e = descriptor.e
+        self.w = descriptor.w
+        self.inv_cs2 = 1.0 / descriptor.cs2
+        self.mask = mask
+        self.direction = direction
+
+    def compile_mask(self, shape):
+        super().compile_mask(shape)
+        dx, dy, dz = self.direction
+        self.neighbours = (self.cells + np.array([dz, dy, dx])) % np.array(shape)
+
+    def apply(self, g, u, phi):
+        self._ensure_compiled(phi.shape)
+        apply_zero_gradient(g, u, phi, self.cells, self.neighbours, self.e, self.w, self.inv_cs2)
@@ -0,0 +1,200 @@
+import copy
+import traceback
+import multiprocessing as mp
+import numpy as np
+import numba
+from lbm_engine.lbm_simulationcore import Lattice3D
+
+""" This file contains a domain decomposed version of Lattice3D. The z-axis is split into slabs, every slab is
+a normal Lattice3D (with one ghost plane below and above) living in its own worker process. Before every step
+the workers exchange the populations that stream across the slab borders (halo exchange), after that every
+worker just steps its own lattice, boundary operators included.
+The workers only talk to each other through a tiny communicator with an mpi4py like send/recv interface,
+so the same worker code can later run on a real MPI communicator instead of the local queue based one. """
+
+#message tags for the halo exchange
+TAG_UP = 1      #populations moving in +z, go to the slab above
+TAG_DOWN = 2    #populations moving in -z, go to the slab below
+
+
+class QueueComm:
+    #local stand-in for an MPI communicator: every rank has an inbox queue, send never blocks
+    def __init__(self, rank, size, inboxes):
+        self.rank = rank
+        self.size = size
+        self.inboxes = inboxes
+        self._pending = {}
+
+    def send(self, obj, dest, tag=0):
+        self.inboxes[dest].put((self.rank, tag, obj))
+
+    def recv(self, source, tag=0):
+        #messages can arrive in any order, keep the ones we don't want yet
+        key = (source, tag)
+        while not self._pending.get(key):
+            msg_source, msg_tag, obj = self.inboxes[self.rank].get()
+            self._pending.setdefault((msg_source, msg_tag), []).append(obj)
+        return self._pending[key].pop(0)
+
+
+class Subdomain3D:
+    """ One z-slab of the decomposed lattice. The local Lattice3D has nz_local + 2 planes, plane 0 and
+    plane nz_local + 1 are the ghost planes that get filled by the halo exchange. The ghost planes are
+    stepped too (that's cheaper than a special kernel) but never used for anything """
+    def __init__(self, comm, nx, ny, nz_local, descriptor, collisionOperator, **lattice_kwargs):
+        self.comm = comm
+        self.nz_local = nz_local
+        self.lattice = Lattice3D(nx, ny, nz_local + 2, descriptor, collisionOperator, **lattice_kwargs)
+        self.up = np.flatnonzero(descriptor.e[:, 2] > 0)
+        self.down = np.flatnonzero(descriptor.e[:, 2] < 0)
+
+    def exchange_halos(self):
+        f = self.lattice.f
+        rank, size = self.comm.rank, self.comm.size
+        above, below = (rank + 1) % size, (rank - 1) % size
+        #only the populations that actually stream into the neighbour slab are sent
+        self.comm.send(np.ascontiguousarray(f[self.nz_local][..., self.up]), dest=above, tag=TAG_UP)
+        self.comm.send(np.ascontiguousarray(f[1][..., self.down]), dest=below, tag=TAG_DOWN)
+        f[0][..., self.up] = self.comm.recv(source=below, tag=TAG_UP)
+        f[self.nz_local + 1][..., self.down] = self.comm.recv(source=above, tag=TAG_DOWN)
+
+    def addOperator(self, name, operator):
+        self.lattice.addOperator(name, operator)
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.exchange_halos()
+            self.lattice.step()
+
+    def save_checkpoint(self, filename, dtype=None):
+        self.lattice.save_checkpoint(filename, dtype)
+
+    def load_checkpoint(self, filename):
+        self.lattice.load_checkpoint(filename)
+        return self.lattice.t
+
+    def gather(self, name):
+        #interior planes of a lattice field (rho, u, f)
+        return np.ascontiguousarray(getattr(self.lattice, name)[1:self.nz_local + 1])
+
+
+def _worker_main(rank, size, inboxes, conn, setup):
+    nx, ny, nz_local, descriptor, collisionOperator, lattice_kwargs, threads = setup
+    if threads is not None:
+        numba.set_num_threads(threads)
+    domain = Subdomain3D(QueueComm(rank, size, inboxes), nx, ny, nz_local, descriptor, collisionOperator, **lattice_kwargs)
+
+    while True:
+        command, args = conn.recv()
+        if command == "stop":
+            break
+        try:
+            conn.send(("ok", getattr(domain, command)(*args)))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+class DecomposedLattice3D:
+    """ Lattice3D split along z into n_domains slabs, each one stepped by its own worker process.
+    Usage is the same as Lattice3D (addOperator, step, rho, u), rho and u are gathered from the workers
+    on access so use them for output only. Operators (and e.g. the velocity_func of a VelocityDirichlet3D)
+    get pickled into the workers: with the default "spawn" start method they have to be defined at module
+    level and the script has to be guarded by if __name__ == "__main__". Only use start_method="fork" if the
+    parent process hasn't run any parallel numba code yet, forking after numba started its thread pool can hang.
+    threads_per_domain sets the numba thread count of every worker, so n_domains * threads_per_domain
+    should not exceed the core count. All Lattice3D keyword arguments are passed on, except streaming="aa"
+    which doesn't work with ghost planes. Call close() (or use it as a context manager) when done """
+    def __init__(self, nx, ny, nz, descriptor, collisionOperator, n_domains=2, threads_per_domain=None,
+                 start_method="spawn", **lattice_kwargs):
+        if lattice_kwargs.get("streaming", "pull") != "pull":
+            raise ValueError("DecomposedLattice3D only supports streaming='pull'")
+        if not 1 <= n_domains <= nz:
+            raise ValueError(f"n_domains has to be between 1 and nz={nz}, got {n_domains}")
+        self.nx, self.ny, self.nz = nx, ny, nz
+        self.descriptor = descriptor
+        self.collisionOperator = collisionOperator
+        self.n_domains = n_domains
+        self.geometry = {}
+        self.t = 0
+
+        #z range [z_bounds[r], z_bounds[r + 1]) belongs to rank r
+        self.z_bounds = np.linspace(0, nz, n_domains + 1).astype(int)
+
+        ctx = mp.get_context(start_method)
+        #keep a reference to the queues, a spawned worker may unpickle them after __init__ returned
+        self._inboxes = [ctx.Queue() for _ in range(n_domains)]
+        self._conns = []
+        self._workers = []
+        for rank in range(n_domains):
+            nz_local = self.z_bounds[rank + 1] - self.z_bounds[rank]
+            setup = (nx, ny, nz_local, descriptor, collisionOperator, lattice_kwargs, threads_per_domain)
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(target=_worker_main, args=(rank, n_domains, self._inboxes, child_conn, setup), daemon=True)
+            worker.start()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+
+    def _call(self, command, args_per_rank):
+        for conn, args in zip(self._conns, args_per_rank):
+            conn.send((command, args))
+        results = []
+        for rank, conn in enumerate(self._conns):
+            status, result = conn.recv()
+            if status == "error":
+                raise RuntimeError(f"Worker {rank} failed on '{command}':\n{result}")
+            results.append(result)
+        return results
+
+    def addOperator(self, name, operator):
+        #every worker gets a copy of the operator with its part of the mask (ghost planes excluded)
+        mask = np.transpose(operator.mask, (2, 1, 0)) if operator.mask.shape != (self.nz, self.ny, self.nx) else operator.mask
+        args = []
+        for rank in range(self.n_domains):
+            z0, z1 = self.z_bounds[rank], self.z_bounds[rank + 1]
+            local_mask = np.zeros((z1 - z0 + 2, self.ny, self.nx), dtype=mask.dtype)
+            local_mask[1:-1] = mask[z0:z1]
+            local_operator = copy.copy(operator)
+            local_operator.mask = local_mask
+            args.append((name, local_operator))
+        self._call("addOperator", args)
+        self.geometry[name] = operator
+
+    def step(self):
+        self.run(1)
+
+    def run(self, steps):
+        #one round trip to the workers for all steps
+        self._call("run", [(steps,)] * self.n_domains)
+        self.t += steps
+
+    def save_checkpoint(self, filename, dtype=None):
+        #every worker writes its own slab (ghost planes included) to filename.<rank>
+        self._call("save_checkpoint", [(f"{filename}.{rank}", dtype) for rank in range(self.n_domains)])
+
+    def load_checkpoint(self, filename):
+        #needs the same n_domains and operators as the run that wrote the checkpoint
+        self.t = self._call("load_checkpoint", [(f"{filename}.{rank}",) for rank in range(self.n_domains)])[0]
+
+    def gather(self, name):
+        return np.concatenate(self._call("gather", [(name,)] * self.n_domains), axis=0)
+
+    @property
+    def rho(self):
+        return self.gather("rho")
+
+    @property
+    def u(self):
+        return self.gather("u")
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(("stop", ()))
+        for worker in self._workers:
+            worker.join()
+        self._conns, self._workers = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
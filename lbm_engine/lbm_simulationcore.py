@@ -1,7 +1,426 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
+from lbm_engine.lbm_collisionOperators import MODEL_BGK, equilibrium_cell2D, equilibrium_cell3D, relax_cell
+from lbm_engine.lbm_io import write_checkpoint, read_checkpoint
+
+##Collision models
+#relax is the tuple from CollisionOperator.relaxation: (model, omega+, omega-, K, opp).
+#BGK is relaxed inline like before, TRT and MRT go through relax_cell with small per row scratch arrays,
+#scratch is a (rows, 3, Q) array the lattice allocates once (row = the prange index).
+#The kernel names still say bgk, they handle all three models
+
+@njit(parallel=True)
+def stream_collide_bgk2D(f, f_new, u, rho, e, w, relax, shift, scratch, monitor, skip):
+    #2D counterpart of stream_collide_bgk: pull the populations from the neighbours into f_new,
+    #compute the moments and relax in place, all in one pass over the lattice (no temporaries)
+    ny, nx, Q = f.shape
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
+
+    for y in prange(ny):
+        feq_c = scratch[y, 0]
+        neq = scratch[y, 1]
+        for x in range(nx):
+            # streaming (periodic, same as the old np.roll version) + moments
+            rho_local = 0.0
+            ux = 0.0
+            uy = 0.0
+            for i in range(Q):
+                fval = f[(y - e[i, 1]) % ny, (x - e[i, 0]) % nx, i]
+                f_new[y, x, i] = fval
+                rho_local += fval
+                ux += fval * e[i, 0]
+                uy += fval * e[i, 1]
+
+            #shift is 1.0 if f stores the deviations f - w_i (sum of w_i = 1), otherwise 0.0
+            rho_local += shift
+            ux = ux / (rho_local + 1e-10)
+            uy = uy / (rho_local + 1e-10)
+            if track and skip[y, x] == 0:
+                monitor[y, 0] += (ux - u[y, x, 0])**2 + (uy - u[y, x, 1])**2
+                monitor[y, 1] += ux**2 + uy**2
+            rho[y, x] = rho_local
+            u[y, x, 0] = ux
+            u[y, x, 1] = uy
+
+            if model != MODEL_BGK:
+                equilibrium_cell2D(feq_c, rho_local, ux, uy, e, w, shift)
+                relax_cell(f_new[y, x], feq_c, model, omega, omega_m, K, opp, neq)
+                continue
+
+            # BGK relaxation towards the local equilibrium
+            u2 = ux**2 + uy**2
+            for i in range(Q):
+                cu = ux * e[i, 0] + uy * e[i, 1]
+                feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                f_new[y, x, i] += -omega * (f_new[y, x, i] - feq)
+
+##AA pattern (single buffer) kernels
+#the AA pattern alternates two kernels on one array f:
+# - even step: read the cell's own populations, collide and write them back into the opposite slots f[x, opp[i]]
+# - odd step: read f[x - e_i, opp[i]] (that's the streamed population), collide and write to f[x + e_i, i]
+#every cell only touches its own set of slots, so this is race free and needs no second buffer.
+#After an odd step f is in the natural layout again (streamed, not yet collided),
+#after an even step it holds the post collision populations with swapped directions.
+#The boundary operators expect the post collision populations in the cell itself (like after the pull kernels),
+#so the lattice moves them there for the operator cells only (swap / gather+scatter helpers below).
+#The arithmetic is exactly the one of the pull kernels so the macroscopic fields are bit for bit the same.
+
+@njit(parallel=True)
+def aa_even_bgk2D(f, u, rho, e, w, relax, shift, opp, scratch, monitor, skip):
+    ny, nx, Q = f.shape
+    model, omega, omega_m, K, _ = relax
+    track = monitor.shape[0] > 0
+
+    for y in prange(ny):
+        feq_c = scratch[y, 0]
+        neq = scratch[y, 1]
+        for x in range(nx):
+            rho_local = 0.0
+            ux = 0.0
+            uy = 0.0
+            for i in range(Q):
+                fval = f[y, x, i]
+                rho_local += fval
+                ux += fval * e[i, 0]
+                uy += fval * e[i, 1]
+
+            rho_local += shift
+            ux = ux / (rho_local + 1e-10)
+            uy = uy / (rho_local + 1e-10)
+            if track and skip[y, x] == 0:
+                monitor[y, 0] += (ux - u[y, x, 0])**2 + (uy - u[y, x, 1])**2
+                monitor[y, 1] += ux**2 + uy**2
+            rho[y, x] = rho_local
+            u[y, x, 0] = ux
+            u[y, x, 1] = uy
+
+            if model != MODEL_BGK:
+                #relax the cell in place, then swap the pairs
+                fc = f[y, x]
+                equilibrium_cell2D(feq_c, rho_local, ux, uy, e, w, shift)
+                relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                for i in range(Q):
+                    j = opp[i]
+                    if j > i:
+                        tmp = fc[i]
+                        fc[i] = fc[j]
+                        fc[j] = tmp
+                continue
+
+            u2 = ux**2 + uy**2
+            for i in range(Q):
+                j = opp[i]
+                if j < i:
+                    continue
+                # relax the pair (i, opp i) and store it swapped
+                cu = ux * e[i, 0] + uy * e[i, 1]
+                feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                a = f[y, x, i]
+                a += -omega * (a - feq)
+                cu = ux * e[j, 0] + uy * e[j, 1]
+                feq = w[j] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[j]
+                b = f[y, x, j]
+                b += -omega * (b - feq)
+                f[y, x, j] = a
+                f[y, x, i] = b
+
+@njit(parallel=True)
+def aa_odd_bgk2D(f, u, rho, e, w, relax, shift, opp, scratch, monitor, skip):
+    ny, nx, Q = f.shape
+    model, omega, omega_m, K, _ = relax
+    track = monitor.shape[0] > 0
+
+    for y in prange(ny):
+        fc = scratch[y, 0]
+        feq_c = scratch[y, 1]
+        neq = scratch[y, 2]
+        for x in range(nx):
+            rho_local = 0.0
+            ux = 0.0
+            uy = 0.0
+            for i in range(Q):
+                fval = f[(y - e[i, 1]) % ny, (x - e[i, 0]) % nx, opp[i]]
+                rho_local += fval
+                ux += fval * e[i, 0]
+                uy += fval * e[i, 1]
+
+            rho_local += shift
+            ux = ux / (rho_local + 1e-10)
+            uy = uy / (rho_local + 1e-10)
+            if track and skip[y, x] == 0:
+                monitor[y, 0] += (ux - u[y, x, 0])**2 + (uy - u[y, x, 1])**2
+                monitor[y, 1] += ux**2 + uy**2
+            rho[y, x] = rho_local
+            u[y, x, 0] = ux
+            u[y, x, 1] = uy
+
+            if model != MODEL_BGK:
+                #the cell reads exactly the slots it writes, so gather -> relax -> scatter is race free too
+                for i in range(Q):
+                    fc[i] = f[(y - e[i, 1]) % ny, (x - e[i, 0]) % nx, opp[i]]
+                equilibrium_cell2D(feq_c, rho_local, ux, uy, e, w, shift)
+                relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                for i in range(Q):
+                    f[(y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i] = fc[i]
+                continue
+
+            u2 = ux**2 + uy**2
+            for i in range(Q):
+                j = opp[i]
+                if j < i:
+                    continue
+                # population i comes in from x - e_i and leaves to x + e_i, for j = opp i it's the other way round
+                ya, xa = (y - e[i, 1]) % ny, (x - e[i, 0]) % nx
+                yb, xb = (y + e[i, 1]) % ny, (x + e[i, 0]) % nx
+                cu = ux * e[i, 0] + uy * e[i, 1]
+                feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                a = f[ya, xa, j]
+                a += -omega * (a - feq)
+                cu = ux * e[j, 0] + uy * e[j, 1]
+                feq = w[j] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[j]
+                b = f[yb, xb, i]
+                b += -omega * (b - feq)
+                f[yb, xb, i] = a
+                f[ya, xa, j] = b
+
+@njit
+def aa_swap_cells2D(f, cells, opp):
+    #swap f[i] <-> f[opp i] on the given (y, x) cells, turns the post even step layout into the natural one (and back)
+    Q = f.shape[2]
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            j = opp[i]
+            if j > i:
+                tmp = f[y, x, i]
+                f[y, x, i] = f[y, x, j]
+                f[y, x, j] = tmp
+
+@njit
+def aa_gather_cells2D(f, cells, e, post, own):
+    #after an odd step the post collision populations of cell x sit in f[x + e_i, i]. For the operators we move them
+    #into the cell itself and park the cell's own (streamed) populations in own, aa_scatter_cells2D undoes this
+    Q = f.shape[2]
+    ny, nx = f.shape[0], f.shape[1]
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            post[k, i] = f[(y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i]
+            own[k, i] = f[y, x, i]
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            f[y, x, i] = post[k, i]
+
+@njit
+def aa_scatter_cells2D(f, cells, e, post, own):
+    Q = f.shape[2]
+    ny, nx = f.shape[0], f.shape[1]
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            post[k, i] = f[y, x, i]
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            f[y, x, i] = own[k, i]
+    #the scatter has to come last, if a neighbour is a boundary cell too its streamed population is exactly this one
+    for k in range(cells.shape[0]):
+        y, x = cells[k, 0], cells[k, 1]
+        for i in range(Q):
+            f[(y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i] = post[k, i]
+
+@njit(parallel=True)
+def aa_swap_all2D(f, opp):
+    ny, nx, Q = f.shape
+    for y in prange(ny):
+        for x in range(nx):
+            for i in range(Q):
+                j = opp[i]
+                if j > i:
+                    tmp = f[y, x, i]
+                    f[y, x, i] = f[y, x, j]
+                    f[y, x, j] = tmp
+
+##Structure of arrays (SoA) kernels
+#with layout="soa" the lattice stores f as (Q, ny, nx) / (Q, nz, ny, nx) in memory, lattice.f stays a (..., Q) view on it
+#so the operators and the AA kernels work unchanged. These kernels take the (Q, ...) array itself and stream whole
+#contiguous rows per direction (vectorizable copies) and also do the moments/relaxation row by row.
+
+@njit
+def stream_row(src, dst, dx):
+    #dst[x] = src[(x - dx) % nx] without a modulo per element
+    nx = dst.shape[0]
+    if dx >= 0:
+        for x in range(dx, nx):
+            dst[x] = src[x - dx]
+        for x in range(dx):
+            dst[x] = src[x - dx + nx]
+    else:
+        for x in range(nx + dx):
+            dst[x] = src[x - dx]
+        for x in range(nx + dx, nx):
+            dst[x] = src[x - dx - nx]
+
+@njit(parallel=True)
+def stream_collide_bgk2D_soa(fs, fs_new, u, rho, e, w, relax, shift, moments, scratch, monitor, skip):
+    #moments is a (ny, 3, nx) scratch array (rho, ux, uy per row), so the moment and relaxation loops can run over
+    #contiguous rows direction by direction. Per cell it's still the same arithmetic as stream_collide_bgk2D
+    Q, ny, nx = fs.shape
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
+
+    for y in prange(ny):
+        m = moments[y]
+        for i in range(Q):
+            stream_row(fs[i, (y - e[i, 1]) % ny], fs_new[i, y], e[i, 0])
+
+        for x in range(nx):
+            m[0, x] = 0.0
+            m[1, x] = 0.0
+            m[2, x] = 0.0
+        for i in range(Q):
+            ex, ey = e[i, 0], e[i, 1]
+            row = fs_new[i, y]
+            for x in range(nx):
+                fval = row[x]
+                m[0, x] += fval
+                m[1, x] += fval * ex
+                m[2, x] += fval * ey
+
+        for x in range(nx):
+            rho_local = m[0, x] + shift
+            m[0, x] = rho_local
+            m[1, x] = m[1, x] / (rho_local + 1e-10)
+            m[2, x] = m[2, x] / (rho_local + 1e-10)
+            if track and skip[y, x] == 0:
+                monitor[y, 0] += (m[1, x] - u[y, x, 0])**2 + (m[2, x] - u[y, x, 1])**2
+                monitor[y, 1] += m[1, x]**2 + m[2, x]**2
+            rho[y, x] = rho_local
+            u[y, x, 0] = m[1, x]
+            u[y, x, 1] = m[2, x]
+
+        if model != MODEL_BGK:
+            #TRT/MRT couple the directions, so collide cell by cell (strided, but the collision dominates anyway)
+            fc = scratch[y, 0]
+            feq_c = scratch[y, 1]
+            neq = scratch[y, 2]
+            for x in range(nx):
+                for i in range(Q):
+                    fc[i] = fs_new[i, y, x]
+                equilibrium_cell2D(feq_c, m[0, x], m[1, x], m[2, x], e, w, shift)
+                relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                for i in range(Q):
+                    fs_new[i, y, x] = fc[i]
+            continue
+
+        for i in range(Q):
+            ex, ey = e[i, 0], e[i, 1]
+            row = fs_new[i, y]
+            for x in range(nx):
+                ux, uy = m[1, x], m[2, x]
+                u2 = ux**2 + uy**2
+                cu = ux * ex + uy * ey
+                feq = w[i] * m[0, x] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                row[x] += -omega * (row[x] - feq)
+
+@njit(parallel=True)
+def stream_collide_bgk_soa(fs, fs_new, u, rho, e, w, relax, shift, moments, scratch, monitor, skip):
+    #moments is a (nz, 4, nx) scratch array, see stream_collide_bgk2D_soa
+    Q, nz, ny, nx = fs.shape
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
+
+    for z in prange(nz):
+        m = moments[z]
+        fc = scratch[z, 0]
+        feq_c = scratch[z, 1]
+        neq = scratch[z, 2]
+        for y in range(ny):
+            for i in range(Q):
+                stream_row(fs[i, (z - e[i, 2]) % nz, (y - e[i, 1]) % ny], fs_new[i, z, y], e[i, 0])
+
+            for x in range(nx):
+                m[0, x] = 0.0
+                m[1, x] = 0.0
+                m[2, x] = 0.0
+                m[3, x] = 0.0
+            for i in range(Q):
+                ex, ey, ez = e[i, 0], e[i, 1], e[i, 2]
+                row = fs_new[i, z, y]
+                for x in range(nx):
+                    fval = row[x]
+                    m[0, x] += fval
+                    m[1, x] += fval * ex
+                    m[2, x] += fval * ey
+                    m[3, x] += fval * ez
+
+            for x in range(nx):
+                rho_local = m[0, x] + shift
+                m[0, x] = rho_local
+                m[1, x] = m[1, x] / (rho_local + 1e-10)
+                m[2, x] = m[2, x] / (rho_local + 1e-10)
+                m[3, x] = m[3, x] / (rho_local + 1e-10)
+                if track and skip[z, y, x] == 0:
+                    monitor[z, 0] += (m[1, x] - u[z, y, x, 0])**2 + (m[2, x] - u[z, y, x, 1])**2 + (m[3, x] - u[z, y, x, 2])**2
+                    monitor[z, 1] += m[1, x]**2 + m[2, x]**2 + m[3, x]**2
+                rho[z, y, x] = rho_local
+                u[z, y, x, 0] = m[1, x]
+                u[z, y, x, 1] = m[2, x]
+                u[z, y, x, 2] = m[3, x]
+
+            if model != MODEL_BGK:
+                for x in range(nx):
+                    for i in range(Q):
+                        fc[i] = fs_new[i, z, y, x]
+                    equilibrium_cell3D(feq_c, m[0, x], m[1, x], m[2, x], m[3, x], e, w, shift)
+                    relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                    for i in range(Q):
+                        fs_new[i, z, y, x] = fc[i]
+                continue
+
+            for i in range(Q):
+                ex, ey, ez = e[i, 0], e[i, 1], e[i, 2]
+                row = fs_new[i, z, y]
+                for x in range(nx):
+                    ux, uy, uz = m[1, x], m[2, x], m[3, x]
+                    u2 = ux**2 + uy**2 + uz**2
+                    cu = ux * ex + uy * ey + uz * ez
+                    feq = w[i] * m[0, x] * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                    row[x] += -omega * (row[x] - feq)
+
+LAYOUTS = ("aos", "soa")
+
+def to_layout(f, layout):
+    #copy f (indexed as (..., Q)) into the requested memory layout, the result is still indexed as (..., Q)
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout '{layout}', use one of {LAYOUTS}")
+    if layout == "soa":
+        return np.moveaxis(np.ascontiguousarray(np.moveaxis(f, -1, 0)), 0, -1)
+    return np.ascontiguousarray(f)
+
+STREAMING_MODES = ("pull", "aa")
+
+#phases of the AA pattern, see aa_even_bgk2D
+AA_NATURAL = 0      #post collision, natural layout (how the lattice is initialized)
+AA_SWAPPED = 1      #post collision, swapped layout -> odd kernel next
+AA_STREAMED = 2     #streamed but not yet collided, natural layout -> even kernel next
+
+def coordinate_grid(shape, sparse=False):
+    """ Cell coordinates like np.meshgrid(np.arange(nx), ..., indexing="ij") without allocating them:
+    full shaped read only broadcast views of the open grids, sparse=True gives the open grids themselves
+    ((nx, 1), (1, ny), ...) for broadcasting. Comparisons like X == 0 give full masks as before,
+    use np.array(X) if you really need the materialized coordinates """
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    return grids if sparse else [np.broadcast_to(grid, tuple(shape)) for grid in grids]
+
 class Lattice2D:
-    def __init__(self, nx, ny, descriptor, collisionOperator):
+    #fields written by save_checkpoint
+    CHECKPOINT_FIELDS = ("f", "rho", "u")
+
+    def __init__(self, nx, ny, descriptor, collisionOperator, streaming="pull", layout="aos",
+                 dtype=np.float64, store_deviation=False):
         #define the lattice dimensions in lattice units
         self.nx, self.ny = nx, ny 
         self.descriptor = descriptor
@@ -15,105 +434,413 @@ class Lattice2D:
         self.Q = descriptor.Q
 
         ##Setup of all the fields needed
-        self.X, self.Y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+        #float32 halves the memory traffic, the kernels still compute the moments in float64
+        self.dtype = np.dtype(dtype)
         self.geometry = {}
         #setup density at 1
-        self.rho = np.ones((ny, nx))
+        self.rho = np.ones((ny, nx), dtype=self.dtype)
         #setup velocity as 0 in all directions (2 for xy)
-        self.u = np.zeros((ny, nx, 2))
-        #setup distribution function as 0 everywhere for all Q directions
-        self.f = np.zeros((ny, nx, self.Q))
+        self.u = np.zeros((ny, nx, 2), dtype=self.dtype)
         #setup of timeStep variable
         self.t = 0
 
         ##setup the distribution function as equilibrium using the collision operator
+        #with store_deviation f holds f - w_i (rest equilibrium subtracted), in float32 this keeps a lot more digits
+        self.f_shift = 1.0 if store_deviation else 0.0
         print("Type of collisionOperator:", type(self.collisionOperator))
-        self.f = self.collisionOperator.compute_feq(self.descriptor, self.rho, self.u)
+        feq = self.collisionOperator.compute_feq(self.descriptor, self.rho, self.u, dtype=np.float64)
+        self.f = (feq - self.f_shift * self.descriptor.w).astype(self.dtype)
 
+        ##Memory layout
+        #"aos": (ny, nx, Q) in memory, "soa": (Q, ny, nx) in memory. self.f is always indexed as [y, x, i]
+        #(for soa it's a view on the Q-major array) so operators and user code don't have to care
+        self.layout = layout
+        self.f = to_layout(self.f, layout)
+        self._moments = np.empty((ny, 3, nx)) if layout == "soa" else None
+        #per row scratch of the kernels (TRT/MRT need feq, neq and the populations of one cell) and the relaxation
+        #parameters of the collision operator, both made once here so step() doesn't allocate anything
+        self._scratch = np.empty((ny, 3, self.Q))
+        self._relax = collisionOperator.relaxation(descriptor)
+
+        ##Streaming scheme
+        #"pull": fused stream&collide into a second buffer, we just swap the two every step
+        #"aa": AA pattern on a single buffer (half the memory), f is only in the natural layout every second step
+        if streaming not in STREAMING_MODES:
+            raise ValueError(f"Unknown streaming mode '{streaming}', use one of {STREAMING_MODES}")
+        self.streaming = streaming
+        self._opp = np.asarray(self.opp)
+        self._f_buf = to_layout(np.empty_like(self.f), layout) if streaming == "pull" else None
+        self._aa_phase = AA_NATURAL
+        #cells touched by any operator + scratch for them, only needed in AA mode
+        self._operator_cells = np.zeros((0, 2), dtype=np.int64)
+        self._aa_post = np.empty((0, self.Q))
+        self._aa_own = np.empty((0, self.Q))
+
+        ##Convergence monitor (see run_until_converged)
+        #the kernels only accumulate the velocity change if _monitor has rows (one per y), cells of any operator
+        #(walls, inlets, ...) are marked in _skip and left out, their velocity is overwritten every step anyway
+        self._monitor = np.zeros((0, 2))
+        self._skip = np.zeros((ny, nx), dtype=np.uint8)
+        self.residual = None
+
+
+    #cell coordinates in (x, y) like the meshgrid masks, only built when used (see coordinate_grid)
+    @property
+    def X(self):
+        return coordinate_grid((self.nx, self.ny))[0]
+
+    @property
+    def Y(self):
+        return coordinate_grid((self.nx, self.ny))[1]
+
+    def grid(self, sparse=False):
+        return coordinate_grid((self.nx, self.ny), sparse)
 
     def addOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
         self.geometry[name] = operator
+        #uint8 masks (load_solid_mask, prune_geometry) would be taken as integer indices
+        mask = np.asarray(operator.mask, dtype=bool)
+        mask = np.transpose(mask) if mask.shape != (self.ny, self.nx) else mask
+        self._skip[mask] = 1
+        if self.streaming == "aa":
+            cells = np.argwhere(mask)
+            self._operator_cells = np.unique(np.concatenate([self._operator_cells, cells]), axis=0)
+            self._aa_post = np.empty((len(self._operator_cells), self.Q), dtype=self.f.dtype)
+            self._aa_own = np.empty_like(self._aa_post)
 
     
 
+    def save_checkpoint(self, filename, dtype=None):
+        """ Saves f, rho, u, t, the AA phase and the operator counters (see lbm_io.write_checkpoint), resuming with
+        load_checkpoint on a lattice that was set up the same way continues bit exact """
+        write_checkpoint(filename, self, dtype)
+
+    def load_checkpoint(self, filename):
+        read_checkpoint(filename, self)
+
     def step(self):
-        ##Streaming Step
-        #for all Q directions we stream the distribution function across the lattice using our discrete velocity set ei
-        #looks complicated af but is actually not that hard
+        ##Streaming & Collision
+        #one fused numba pass: pull streaming (periodic) -> rho and u -> BGK relaxation
         #this is periodic -> if you dont want this you have to continously overwrite the boundary conditions
-        for i in range(self.Q):
-            self.f[:, :, i] = np.roll(
-                np.roll(self.f[:, :, i], self.e[i, 0], axis=1),
-                self.e[i, 1], axis=0
-            )
-        
-        ##Here we iterate over the operators in the operator List and call the apply method for each one to apply boundary conditions
-        for operator in self.geometry.values():
-            #print(operator)
-            operator.apply(self.f, self.u, self.rho)
-        
-        #calculate density from distribution function 
-        self.rho = np.sum(self.f, axis=2)
-        #calculate x component of velocity set from the distribution function (use direction vectors as weights (TM1 flashback))
-        self.u[:, :, 0] = np.sum(self.f * self.e[:, 0], axis=2) / self.rho
-        #same for y component
-        self.u[:, :, 1] = np.sum(self.f * self.e[:, 1], axis=2) / self.rho
+        if self.streaming == "aa":
+            self._step_aa()
+        else:
+            if self.layout == "soa":
+                #the SoA kernel wants the (Q, ny, nx) arrays themselves
+                stream_collide_bgk2D_soa(
+                    np.moveaxis(self.f, -1, 0), np.moveaxis(self._f_buf, -1, 0), self.u, self.rho,
+                    self.e,
+                    self.descriptor.w,
+                    self._relax,
+                    self.f_shift,
+                    self._moments,
+                    self._scratch,
+                    self._monitor,
+                    self._skip
+                )
+            else:
+                stream_collide_bgk2D(
+                    self.f, self._f_buf, self.u, self.rho,
+                    self.e,
+                    self.descriptor.w,
+                    self._relax,
+                    self.f_shift,
+                    self._scratch,
+                    self._monitor,
+                    self._skip
+                )
+            self.f, self._f_buf = self._f_buf, self.f
 
-
-        ##Collision Step
-        #Calculate delta f from collision Operator
-        self.f += self.collisionOperator.compute_delta_f(self.descriptor, self.f, self.rho, self.u)
+            ##Here we iterate over the operators in the operator List and call the apply method for each one to apply boundary conditions
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
 
         #We are done with this Stream&Collide so increment timeStep
         self.t += 1
 
+    def run_until_converged(self, tol=1e-6, check_interval=100, max_steps=100000):
+        """ Step until the flow is steady or max_steps steps are done, returns True if it converged.
+        Every check_interval steps the kernel also sums up |u_new - u_old|^2 and |u_new|^2 (no copy of u needed),
+        the residual sqrt(sum |du|^2 / sum |u|^2) is the relative velocity change of that single step and is kept in
+        self.residual. Cells of the operators (walls, inlets, outlets) are not counted. Since the change is relative
+        a flow that just decays to rest never converges, use it for driven flows """
+        steps = 0
+        while steps < max_steps:
+            n = min(check_interval, max_steps - steps)
+            for _ in range(n - 1):
+                self.step()
+            self._monitor = np.zeros((self.ny, 2))
+            self.step()
+            du2, u2 = self._monitor.sum(axis=0)
+            self._monitor = np.zeros((0, 2))
+            steps += n
+            self.residual = np.sqrt(du2 / u2) if u2 > 0 else 0.0
+            if self.residual < tol:
+                return True
+        return False
+
+    def _step_aa(self):
+        w, relax = self.descriptor.w, self._relax
+        if self._aa_phase == AA_NATURAL:
+            #first step: bring the initial (post collision) f into the swapped layout the odd kernel expects
+            aa_swap_all2D(self.f, self._opp)
+            self._aa_phase = AA_SWAPPED
+
+        if self._aa_phase == AA_SWAPPED:
+            aa_odd_bgk2D(self.f, self.u, self.rho, self.e, w, relax, self.f_shift, self._opp, self._scratch, self._monitor, self._skip)
+            self._aa_phase = AA_STREAMED
+            #the post collision populations were already pushed to the neighbours -> pull them back for the operators
+            aa_gather_cells2D(self.f, self._operator_cells, self.e, self._aa_post, self._aa_own)
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
+            aa_scatter_cells2D(self.f, self._operator_cells, self.e, self._aa_post, self._aa_own)
+        else:
+            aa_even_bgk2D(self.f, self.u, self.rho, self.e, w, relax, self.f_shift, self._opp, self._scratch, self._monitor, self._skip)
+            self._aa_phase = AA_SWAPPED
+            #post collision but swapped -> unswap the boundary cells for the operators and swap them back afterwards
+            aa_swap_cells2D(self.f, self._operator_cells, self._opp)
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
+            aa_swap_cells2D(self.f, self._operator_cells, self._opp)
+
 from numba import njit, prange
 import numpy as np
 
 @njit(parallel=True)
-def stream_collide_bgk(f, u, rho, e, w, tau):
+def stream_collide_bgk(f, f_new, u, rho, e, w, relax, shift, scratch, monitor, skip):
+    #f_new is the second (preallocated) buffer of the lattice, nothing gets allocated in here (the TRT/MRT scratch comes from the lattice too)
     nz, ny, nx, Q = f.shape
-    f_new = np.empty_like(f)
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
 
-    # streaming step
-    for i in prange(Q):
-        dx, dy, dz = e[i]
-        for z in range(nz):
-            for y in range(ny):
-                for x in range(nx):
-                    zp = (z - dz) % nz
-                    yp = (y - dy) % ny
-                    xp = (x - dx) % nx
-                    f_new[z, y, x, i] = f[zp, yp, xp, i]
+    for z in prange(nz):
+        feq_c = scratch[z, 0]
+        neq = scratch[z, 1]
+        for y in range(ny):
+            for x in range(nx):
+                # streaming (pull from the neighbours, periodic) + macroscopic moments
+                rho_local = 0.0
+                ux = 0.0
+                uy = 0.0
+                uz = 0.0
+                for i in range(Q):
+                    fval = f[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx, i]
+                    f_new[z, y, x, i] = fval
+                    rho_local += fval
+                    ux += fval * e[i, 0]
+                    uy += fval * e[i, 1]
+                    uz += fval * e[i, 2]
+
+                rho_local += shift
+                ux = ux / (rho_local + 1e-10)
+                uy = uy / (rho_local + 1e-10)
+                uz = uz / (rho_local + 1e-10)
+                if track and skip[z, y, x] == 0:
+                    monitor[z, 0] += (ux - u[z, y, x, 0])**2 + (uy - u[z, y, x, 1])**2 + (uz - u[z, y, x, 2])**2
+                    monitor[z, 1] += ux**2 + uy**2 + uz**2
+                rho[z, y, x] = rho_local
+                u[z, y, x, 0] = ux
+                u[z, y, x, 1] = uy
+                u[z, y, x, 2] = uz
+
+                if model != MODEL_BGK:
+                    equilibrium_cell3D(feq_c, rho_local, ux, uy, uz, e, w, shift)
+                    relax_cell(f_new[z, y, x], feq_c, model, omega, omega_m, K, opp, neq)
+                    continue
+
+                # BGK relaxation
+                u2 = ux**2 + uy**2 + uz**2
+                for i in range(Q):
+                    cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+                    feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                    f_new[z, y, x, i] += -omega * (f_new[z, y, x, i] - feq)
+
+@njit(parallel=True)
+def aa_even_bgk(f, u, rho, e, w, relax, shift, opp, scratch, monitor, skip):
+    #3D versions of the AA kernels, see aa_even_bgk2D for how the pattern works
+    nz, ny, nx, Q = f.shape
+    model, omega, omega_m, K, _ = relax
+    track = monitor.shape[0] > 0
 
-    # wtf is this and why does it work (macroscopic)
     for z in prange(nz):
+        feq_c = scratch[z, 0]
+        neq = scratch[z, 1]
         for y in range(ny):
             for x in range(nx):
                 rho_local = 0.0
-                u_local = np.zeros(3)
+                ux = 0.0
+                uy = 0.0
+                uz = 0.0
                 for i in range(Q):
-                    fval = f_new[z, y, x, i]
+                    fval = f[z, y, x, i]
                     rho_local += fval
-                    for d in range(3):
-                        u_local[d] += fval * e[i, d]
+                    ux += fval * e[i, 0]
+                    uy += fval * e[i, 1]
+                    uz += fval * e[i, 2]
 
+                rho_local += shift
+                ux = ux / (rho_local + 1e-10)
+                uy = uy / (rho_local + 1e-10)
+                uz = uz / (rho_local + 1e-10)
+                if track and skip[z, y, x] == 0:
+                    monitor[z, 0] += (ux - u[z, y, x, 0])**2 + (uy - u[z, y, x, 1])**2 + (uz - u[z, y, x, 2])**2
+                    monitor[z, 1] += ux**2 + uy**2 + uz**2
                 rho[z, y, x] = rho_local
-                for d in range(3):
-                    u[z, y, x, d] = u_local[d] / (rho_local + 1e-10)
+                u[z, y, x, 0] = ux
+                u[z, y, x, 1] = uy
+                u[z, y, x, 2] = uz
+
+                if model != MODEL_BGK:
+                    fc = f[z, y, x]
+                    equilibrium_cell3D(feq_c, rho_local, ux, uy, uz, e, w, shift)
+                    relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                    for i in range(Q):
+                        j = opp[i]
+                        if j > i:
+                            tmp = fc[i]
+                            fc[i] = fc[j]
+                            fc[j] = tmp
+                    continue
+
+                u2 = ux**2 + uy**2 + uz**2
+                for i in range(Q):
+                    j = opp[i]
+                    if j < i:
+                        continue
+                    cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+                    feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                    a = f[z, y, x, i]
+                    a += -omega * (a - feq)
+                    cu = ux * e[j, 0] + uy * e[j, 1] + uz * e[j, 2]
+                    feq = w[j] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[j]
+                    b = f[z, y, x, j]
+                    b += -omega * (b - feq)
+                    f[z, y, x, j] = a
+                    f[z, y, x, i] = b
+
+@njit(parallel=True)
+def aa_odd_bgk(f, u, rho, e, w, relax, shift, opp, scratch, monitor, skip):
+    nz, ny, nx, Q = f.shape
+    model, omega, omega_m, K, _ = relax
+    track = monitor.shape[0] > 0
 
-                u2 = np.sum(u[z, y, x] ** 2)
+    for z in prange(nz):
+        fc = scratch[z, 0]
+        feq_c = scratch[z, 1]
+        neq = scratch[z, 2]
+        for y in range(ny):
+            for x in range(nx):
+                rho_local = 0.0
+                ux = 0.0
+                uy = 0.0
+                uz = 0.0
                 for i in range(Q):
-                    cu = 0.0
-                    for d in range(3):
-                        cu += u[z, y, x, d] * e[i, d]
-                    feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2)
-                    f_new[z, y, x, i] += -(1.0 / tau) * (f_new[z, y, x, i] - feq)
+                    fval = f[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx, opp[i]]
+                    rho_local += fval
+                    ux += fval * e[i, 0]
+                    uy += fval * e[i, 1]
+                    uz += fval * e[i, 2]
 
-    return f_new
+                rho_local += shift
+                ux = ux / (rho_local + 1e-10)
+                uy = uy / (rho_local + 1e-10)
+                uz = uz / (rho_local + 1e-10)
+                if track and skip[z, y, x] == 0:
+                    monitor[z, 0] += (ux - u[z, y, x, 0])**2 + (uy - u[z, y, x, 1])**2 + (uz - u[z, y, x, 2])**2
+                    monitor[z, 1] += ux**2 + uy**2 + uz**2
+                rho[z, y, x] = rho_local
+                u[z, y, x, 0] = ux
+                u[z, y, x, 1] = uy
+                u[z, y, x, 2] = uz
+
+                if model != MODEL_BGK:
+                    for i in range(Q):
+                        fc[i] = f[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx, opp[i]]
+                    equilibrium_cell3D(feq_c, rho_local, ux, uy, uz, e, w, shift)
+                    relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                    for i in range(Q):
+                        f[(z + e[i, 2]) % nz, (y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i] = fc[i]
+                    continue
+
+                u2 = ux**2 + uy**2 + uz**2
+                for i in range(Q):
+                    j = opp[i]
+                    if j < i:
+                        continue
+                    za, ya, xa = (z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx
+                    zb, yb, xb = (z + e[i, 2]) % nz, (y + e[i, 1]) % ny, (x + e[i, 0]) % nx
+                    cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+                    feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                    a = f[za, ya, xa, j]
+                    a += -omega * (a - feq)
+                    cu = ux * e[j, 0] + uy * e[j, 1] + uz * e[j, 2]
+                    feq = w[j] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[j]
+                    b = f[zb, yb, xb, i]
+                    b += -omega * (b - feq)
+                    f[zb, yb, xb, i] = a
+                    f[za, ya, xa, j] = b
+
+@njit
+def aa_swap_cells(f, cells, opp):
+    Q = f.shape[3]
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            j = opp[i]
+            if j > i:
+                tmp = f[z, y, x, i]
+                f[z, y, x, i] = f[z, y, x, j]
+                f[z, y, x, j] = tmp
+
+@njit
+def aa_gather_cells(f, cells, e, post, own):
+    nz, ny, nx, Q = f.shape
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            post[k, i] = f[(z + e[i, 2]) % nz, (y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i]
+            own[k, i] = f[z, y, x, i]
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            f[z, y, x, i] = post[k, i]
+
+@njit
+def aa_scatter_cells(f, cells, e, post, own):
+    nz, ny, nx, Q = f.shape
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            post[k, i] = f[z, y, x, i]
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            f[z, y, x, i] = own[k, i]
+    for k in range(cells.shape[0]):
+        z, y, x = cells[k, 0], cells[k, 1], cells[k, 2]
+        for i in range(Q):
+            f[(z + e[i, 2]) % nz, (y + e[i, 1]) % ny, (x + e[i, 0]) % nx, i] = post[k, i]
+
+@njit(parallel=True)
+def aa_swap_all(f, opp):
+    nz, ny, nx, Q = f.shape
+    for z in prange(nz):
+        for y in range(ny):
+            for x in range(nx):
+                for i in range(Q):
+                    j = opp[i]
+                    if j > i:
+                        tmp = f[z, y, x, i]
+                        f[z, y, x, i] = f[z, y, x, j]
+                        f[z, y, x, j] = tmp
 
 class Lattice3D:
-    def __init__(self, nx, ny, nz, descriptor, collisionOperator):
+    CHECKPOINT_FIELDS = ("f", "rho", "u")
+
+    def __init__(self, nx, ny, nz, descriptor, collisionOperator, streaming="pull", layout="aos",
+                 dtype=np.float64, store_deviation=False):
         self.nx, self.ny, self.nz = nx, ny, nz
         self.descriptor = descriptor
         self.collisionOperator = collisionOperator
@@ -121,46 +848,325 @@ class Lattice3D:
         self.opp = descriptor.opp
         self.Q = descriptor.Q
 
-        #setup grid
-        self.X, self.Y, self.Z = np.meshgrid(
-            np.arange(nx), np.arange(ny), np.arange(nz), indexing='ij'
-        )
-
         self.geometry = {}
 
-        #field initialization
-        self.rho = np.ones((nz, ny, nx))                     #density field
-        self.u = np.zeros((nz, ny, nx, 3))                   #velocity field
-        self.f = np.zeros((nz, ny, nx, self.Q))              #distributin function
+        #field initialization (dtype float32 or float64, see Lattice2D)
+        self.dtype = np.dtype(dtype)
+        self.rho = np.ones((nz, ny, nx), dtype=self.dtype)                     #density field
+        self.u = np.zeros((nz, ny, nx, 3), dtype=self.dtype)                   #velocity field
         self.t = 0                                            #time step counter
 
-        #initialize f as equilibrium distribution
+        #initialize f as equilibrium distribution (minus w_i with store_deviation, see Lattice2D)
+        self.f_shift = 1.0 if store_deviation else 0.0
         print("Type of collisionOperator:", type(self.collisionOperator))
-        self.f = self.collisionOperator.compute_feq(self.descriptor, self.rho, self.u)
+        feq = self.collisionOperator.compute_feq(self.descriptor, self.rho, self.u, dtype=np.float64)
+        self.f = (feq - self.f_shift * self.descriptor.w).astype(self.dtype)
+
+        #memory layout, see Lattice2D (self.f is always indexed as [z, y, x, i])
+        self.layout = layout
+        self.f = to_layout(self.f, layout)
+        self._moments = np.empty((nz, 4, nx)) if layout == "soa" else None
+        #see Lattice2D, one scratch row per z plane
+        self._scratch = np.empty((nz, 3, self.Q))
+        self._relax = collisionOperator.relaxation(descriptor)
+
+        #streaming scheme, see Lattice2D
+        if streaming not in STREAMING_MODES:
+            raise ValueError(f"Unknown streaming mode '{streaming}', use one of {STREAMING_MODES}")
+        self.streaming = streaming
+        self._opp = np.asarray(self.opp)
+        #ping-pong buffer, swapped with f every step so stepping never allocates (not needed for AA)
+        self._f_buf = to_layout(np.empty_like(self.f), layout) if streaming == "pull" else None
+        self._aa_phase = AA_NATURAL
+        self._operator_cells = np.zeros((0, 3), dtype=np.int64)
+        self._aa_post = np.empty((0, self.Q))
+        self._aa_own = np.empty((0, self.Q))
+        #convergence monitor, see Lattice2D
+        self._monitor = np.zeros((0, 2))
+        self._skip = np.zeros((nz, ny, nx), dtype=np.uint8)
+        self.residual = None
+
+    #cell coordinates in (x, y, z), see Lattice2D.X
+    @property
+    def X(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[0]
+
+    @property
+    def Y(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[1]
+
+    @property
+    def Z(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[2]
+
+    def grid(self, sparse=False):
+        return coordinate_grid((self.nx, self.ny, self.nz), sparse)
 
     def addOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
         self.geometry[name] = operator
+        #see Lattice2D.addOperator
+        mask = np.asarray(operator.mask, dtype=bool)
+        mask = np.transpose(mask, (2, 1, 0)) if mask.shape != (self.nz, self.ny, self.nx) else mask
+        self._skip[mask] = 1
+        if self.streaming == "aa":
+            cells = np.argwhere(mask)
+            self._operator_cells = np.unique(np.concatenate([self._operator_cells, cells]), axis=0)
+            self._aa_post = np.empty((len(self._operator_cells), self.Q), dtype=self.f.dtype)
+            self._aa_own = np.empty_like(self._aa_post)
+
+    def save_checkpoint(self, filename, dtype=None):
+        #see Lattice2D.save_checkpoint
+        write_checkpoint(filename, self, dtype)
+
+    def load_checkpoint(self, filename):
+        read_checkpoint(filename, self)
 
     def step(self):
         # --- Streaming & Collision ---
-        self.f = stream_collide_bgk(
-            self.f, self.u, self.rho,
+        if self.streaming == "aa":
+            self._step_aa()
+        else:
+            if self.layout == "soa":
+                stream_collide_bgk_soa(
+                    np.moveaxis(self.f, -1, 0), np.moveaxis(self._f_buf, -1, 0), self.u, self.rho,
+                    self.descriptor.e,
+                    self.descriptor.w,
+                    self._relax,
+                    self.f_shift,
+                    self._moments,
+                    self._scratch,
+                    self._monitor,
+                    self._skip
+                )
+            else:
+                stream_collide_bgk(
+                    self.f, self._f_buf, self.u, self.rho,
+                    self.descriptor.e,
+                    self.descriptor.w,
+                    self._relax,
+                    self.f_shift,
+                    self._scratch,
+                    self._monitor,
+                    self._skip
+                )
+            self.f, self._f_buf = self._f_buf, self.f
+
+            # --- Boundary conditions ---
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
+
+        self.t += 1
+
+    def run_until_converged(self, tol=1e-6, check_interval=100, max_steps=100000):
+        # same as Lattice2D.run_until_converged
+        steps = 0
+        while steps < max_steps:
+            n = min(check_interval, max_steps - steps)
+            for _ in range(n - 1):
+                self.step()
+            self._monitor = np.zeros((self.nz, 2))
+            self.step()
+            du2, u2 = self._monitor.sum(axis=0)
+            self._monitor = np.zeros((0, 2))
+            steps += n
+            self.residual = np.sqrt(du2 / u2) if u2 > 0 else 0.0
+            if self.residual < tol:
+                return True
+        return False
+
+    def _step_aa(self):
+        # same as Lattice2D._step_aa
+        w, relax = self.descriptor.w, self._relax
+        if self._aa_phase == AA_NATURAL:
+            aa_swap_all(self.f, self._opp)
+            self._aa_phase = AA_SWAPPED
+
+        if self._aa_phase == AA_SWAPPED:
+            aa_odd_bgk(self.f, self.u, self.rho, self.e, w, relax, self.f_shift, self._opp, self._scratch, self._monitor, self._skip)
+            self._aa_phase = AA_STREAMED
+            aa_gather_cells(self.f, self._operator_cells, self.e, self._aa_post, self._aa_own)
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
+            aa_scatter_cells(self.f, self._operator_cells, self.e, self._aa_post, self._aa_own)
+        else:
+            aa_even_bgk(self.f, self.u, self.rho, self.e, w, relax, self.f_shift, self._opp, self._scratch, self._monitor, self._skip)
+            self._aa_phase = AA_SWAPPED
+            aa_swap_cells(self.f, self._operator_cells, self._opp)
+            for operator in self.geometry.values():
+                operator.apply(self.f, self.u, self.rho)
+            aa_swap_cells(self.f, self._operator_cells, self._opp)
+
+
+
+@njit(parallel=True)
+def build_pull_table(cell_index, cells, e, opp, index_dtype):
+    #for every fluid cell n and direction i this stores the flat position (in f.reshape(-1)) the population
+    #streams in from. If the upstream neighbour is solid we point at the opposite population of the cell itself,
+    #so halfway bounce-back is already folded into the table and no solid cell has to be stored or scanned
+    nz, ny, nx = cell_index.shape
+    N = cells.shape[0]
+    Q = e.shape[0]
+    src = np.empty((N, Q), dtype=index_dtype)
+    for n in prange(N):
+        z, y, x = cells[n, 0], cells[n, 1], cells[n, 2]
+        for i in range(Q):
+            m = cell_index[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx]
+            if m >= 0:
+                src[n, i] = m * Q + i
+            else:
+                src[n, i] = n * Q + opp[i]
+    return src
+
+SPARSE_BLOCK = 256
+
+@njit(parallel=True)
+def stream_collide_bgk_sparse(f_flat, f_new, u, rho, src, e, w, relax, shift, scratch):
+    #same as stream_collide_bgk but on the compact (N, Q) fluid cell list, f_flat is f.reshape(-1).
+    #The cells are handed out in blocks, every block uses its own row of the TRT/MRT scratch
+    N, Q = f_new.shape
+    model, omega, omega_m, K, opp = relax
+
+    for b in prange((N + SPARSE_BLOCK - 1) // SPARSE_BLOCK):
+        feq_c = scratch[b, 0]
+        neq = scratch[b, 1]
+        for n in range(b * SPARSE_BLOCK, min(N, (b + 1) * SPARSE_BLOCK)):
+            rho_local = 0.0
+            ux = 0.0
+            uy = 0.0
+            uz = 0.0
+            for i in range(Q):
+                fval = f_flat[src[n, i]]
+                f_new[n, i] = fval
+                rho_local += fval
+                ux += fval * e[i, 0]
+                uy += fval * e[i, 1]
+                uz += fval * e[i, 2]
+
+            rho_local += shift
+            ux = ux / (rho_local + 1e-10)
+            uy = uy / (rho_local + 1e-10)
+            uz = uz / (rho_local + 1e-10)
+            rho[n] = rho_local
+            u[n, 0] = ux
+            u[n, 1] = uy
+            u[n, 2] = uz
+
+            if model != MODEL_BGK:
+                equilibrium_cell3D(feq_c, rho_local, ux, uy, uz, e, w, shift)
+                relax_cell(f_new[n], feq_c, model, omega, omega_m, K, opp, neq)
+                continue
+
+            u2 = ux**2 + uy**2 + uz**2
+            for i in range(Q):
+                cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+                feq = w[i] * rho_local * (1 + 3*cu + 4.5*cu**2 - 1.5*u2) - shift * w[i]
+                f_new[n, i] += -omega * (f_new[n, i] - feq)
+
+class SparseLattice3D:
+    """ Indirect addressing lattice for porous media: only the fluid cells are stored in a compact
+    (N, Q) array and streaming goes through a neighbour table that is built once from the solid mask.
+    Solid cells are bounced back (halfway) through that table, so don't add a BounceBack3D operator,
+    everything else (inlets/outlets) works with operators that provide apply_indexed.
+    rho, u and f are stored per fluid cell, use to_dense() to get the full (nz, ny, nx) fields for exporting """
+    CHECKPOINT_FIELDS = ("f", "rho", "u")
+
+    def __init__(self, nx, ny, nz, descriptor, collisionOperator, solid_mask, dtype=np.float64, store_deviation=False):
+        self.nx, self.ny, self.nz = nx, ny, nz
+        self.descriptor = descriptor
+        self.collisionOperator = collisionOperator
+        self.e = descriptor.e
+        self.opp = descriptor.opp
+        self.Q = descriptor.Q
+
+        #masks from meshgrid/load_mask_from_vti come in (x, y, z), the lattice works in (z, y, x)
+        solid = self._orient_mask(np.asarray(solid_mask, dtype=bool))
+        fluid = ~solid
+
+        #fluid cell list and the map from grid position to cell number (-1 for solid)
+        self.cells = np.argwhere(fluid)
+        self.N = self.cells.shape[0]
+        index_dtype = np.int32 if self.N * self.Q < np.iinfo(np.int32).max else np.int64
+        self.cell_index = np.full((nz, ny, nx), -1, dtype=index_dtype)
+        self.cell_index[fluid] = np.arange(self.N, dtype=index_dtype)
+        self.src = build_pull_table(self.cell_index, self.cells, self.e, np.asarray(self.opp), index_dtype)
+        self.porosity = self.N / (nx * ny * nz)
+
+        self.geometry = {}
+        self._operator_cells = {}
+
+        #field initialization (one entry per fluid cell), dtype and store_deviation work like on Lattice3D
+        self.dtype = np.dtype(dtype)
+        self.rho = np.ones(self.N, dtype=self.dtype)
+        self.u = np.zeros((self.N, 3), dtype=self.dtype)
+        self.t = 0
+
+        #compute_feq works on (nz, ny, nx) fields, so we just hand it the cell list as one long row
+        self.f_shift = 1.0 if store_deviation else 0.0
+        print("Type of collisionOperator:", type(self.collisionOperator))
+        feq = self.collisionOperator.compute_feq(
+            self.descriptor, self.rho.reshape(1, 1, self.N), self.u.reshape(1, 1, self.N, 3), dtype=np.float64
+        )
+        self.f = (feq.reshape(self.N, self.Q) - self.f_shift * self.descriptor.w).astype(self.dtype)
+        self._f_buf = np.empty_like(self.f)
+        #one scratch row per block of cells, see Lattice2D
+        self._scratch = np.empty(((self.N + SPARSE_BLOCK - 1) // SPARSE_BLOCK, 3, self.Q))
+        self._relax = collisionOperator.relaxation(descriptor)
+
+    def _orient_mask(self, mask):
+        return np.transpose(mask, (2, 1, 0)) if mask.shape != (self.nz, self.ny, self.nx) else mask
+
+    def addOperator(self, name, operator):
+        if not hasattr(operator, "apply_indexed"):
+            raise ValueError(
+                f"{type(operator).__name__} can't be used on a SparseLattice3D "
+                "(solid cells are handled by the neighbour table, pass them as solid_mask)"
+            )
+        if hasattr(operator, "bind"):
+            operator.bind(self)
+        #translate the operator mask into fluid cell numbers once, solid cells in the mask are dropped
+        cells = self.cell_index[self._orient_mask(np.asarray(operator.mask, dtype=bool))]
+        self._operator_cells[name] = cells[cells >= 0]
+        self.geometry[name] = operator
+
+    def to_dense(self, values, fill_value=0.0):
+        #scatter a per-cell field (N,) or (N, k) back to the full (nz, ny, nx[, k]) grid
+        dense = np.full((self.nz, self.ny, self.nx) + values.shape[1:], fill_value, dtype=values.dtype)
+        dense[self.cells[:, 0], self.cells[:, 1], self.cells[:, 2]] = values
+        return dense
+
+    def save_checkpoint(self, filename, dtype=None):
+        #see Lattice2D.save_checkpoint
+        write_checkpoint(filename, self, dtype)
+
+    def load_checkpoint(self, filename):
+        read_checkpoint(filename, self)
+
+    def step(self):
+        # --- Streaming & Collision (bounce-back included) ---
+        stream_collide_bgk_sparse(
+            self.f.reshape(-1), self._f_buf, self.u, self.rho, self.src,
             self.descriptor.e,
             self.descriptor.w,
-            self.collisionOperator.tau
+            self._relax,
+            self.f_shift,
+            self._scratch
         )
+        self.f, self._f_buf = self._f_buf, self.f
 
         # --- Boundary conditions ---
-        for operator in self.geometry.values():
-            operator.apply(self.f, self.u, self.rho)
+        for name, operator in self.geometry.items():
+            operator.apply_indexed(self.f, self.u, self.rho, self._operator_cells[name])
 
         self.t += 1
 
 
-
 class ScalarLattice2D:
     #this is pretty much the same as the regular Lattice but it contains a scalar field used for diffusive transport etc
-    def __init__(self, nx, ny, descriptor, collisionOperator):
+    CHECKPOINT_FIELDS = ("g", "phi", "u")
+
+    def __init__(self, nx, ny, descriptor, collisionOperator, dtype=np.float64):
         #define the lattice dimensions in lattice units
         self.nx, self.ny = nx, ny 
         self.descriptor = descriptor
@@ -173,15 +1179,13 @@ class ScalarLattice2D:
         #get the unique velocity count from descriptor definition
         self.Q = descriptor.Q
 
-        ##Setup of all the fields needed
-        self.X, self.Y = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+        ##Setup of all the fields needed (float32 or float64)
+        self.dtype = np.dtype(dtype)
         self.geometry = {}
         #setup velocity as 0 in all directions (2 for xy)
-        self.u = np.zeros((ny, nx, 2))
+        self.u = np.zeros((ny, nx, 2), dtype=self.dtype)
         #setup scalar field as 1 everywhere
-        self.phi = np.ones((ny, nx))
-        #setup distribution function as 0 everywhere for all Q directions
-        self.g= np.zeros((ny, nx, self.Q))
+        self.phi = np.ones((ny, nx), dtype=self.dtype)
         #setup of timeStep variable
         self.t = 0
 
@@ -189,14 +1193,36 @@ class ScalarLattice2D:
         print("Type of collisionOperator:", type(self.collisionOperator))
         self.g = self.collisionOperator.compute_feq(self.descriptor, self.phi, self.u)
 
+    #cell coordinates in (x, y) see Lattice2D.X
+    @property
+    def X(self):
+        return coordinate_grid((self.nx, self.ny))[0]
+
+    @property
+    def Y(self):
+        return coordinate_grid((self.nx, self.ny))[1]
+
+    def grid(self, sparse=False):
+        return coordinate_grid((self.nx, self.ny), sparse)
+
     def addOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
         self.geometry[name] = operator
 
+    def save_checkpoint(self, filename, dtype=None):
+        #see Lattice2D.save_checkpoint
+        write_checkpoint(filename, self, dtype)
+
+    def load_checkpoint(self, filename):
+        read_checkpoint(filename, self)
+
     def step(self):
         for i in range(self.Q):
             self.g[:, :, i] = np.roll(np.roll(self.g[:, :, i], self.e[i, 0], axis=1), self.e[i, 1], axis=0)
 
-        self.phi = np.sum(self.g, axis=2)
+        #sum up in float64 even if g is float32
+        self.phi = np.sum(self.g, axis=2, dtype=np.float64).astype(self.dtype)
 
         for operator in self.geometry.values():
             operator.apply(self.g, self.u, self.phi)
@@ -205,6 +1231,384 @@ class ScalarLattice2D:
         #We are done with this Stream&Collide so increment timeStep
         self.t +=1
 
+@njit(parallel=True)
+def stream_collide_advdiff(g, g_new, u, phi, e, w, tau, inv_cs2):
+    #scalar version of stream_collide_bgk: pull streaming (periodic), phi = sum of g, BGK relaxation towards
+    #the advection diffusion equilibrium w_i * phi * (1 + e_i.u / cs^2). u is given (e.g. from a Lattice3D)
+    nz, ny, nx, Q = g.shape
+    omega = 1.0 / tau
+
+    for z in prange(nz):
+        for y in range(ny):
+            for x in range(nx):
+                phi_local = 0.0
+                for i in range(Q):
+                    gval = g[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx, i]
+                    g_new[z, y, x, i] = gval
+                    phi_local += gval
+                phi[z, y, x] = phi_local
+
+                ux, uy, uz = u[z, y, x, 0], u[z, y, x, 1], u[z, y, x, 2]
+                for i in range(Q):
+                    cu = ux * e[i, 0] + uy * e[i, 1] + uz * e[i, 2]
+                    geq = w[i] * phi_local * (1 + inv_cs2 * cu)
+                    g_new[z, y, x, i] += -omega * (g_new[z, y, x, i] - geq)
+
+class ScalarLattice3D:
+    """ 3D scalar transport (advection-diffusion) lattice, meant to be used with the compact D3Q7 descriptor and
+    BGK_AdvectionDiffusion_collisionOperator (diffusivity D = cs2 * (tau - 1/2), 1/4 * (tau - 1/2) for D3Q7).
+    Set u from a flow lattice (e.g. scalar.u[...] = flow.u) before stepping. Stream and collide are one fused
+    numba pass, the operators (ConstantScalarDirichlet3D, ZeroGradientOutlet3D) are applied afterwards """
+    CHECKPOINT_FIELDS = ("g", "phi", "u")
+
+    def __init__(self, nx, ny, nz, descriptor, collisionOperator, dtype=np.float64):
+        self.nx, self.ny, self.nz = nx, ny, nz
+        self.descriptor = descriptor
+        self.collisionOperator = collisionOperator
+        self.e = descriptor.e
+        self.opp = descriptor.opp
+        self.Q = descriptor.Q
+
+        self.geometry = {}
+
+        #field initialization, phi = 1 everywhere and no velocity
+        self.dtype = np.dtype(dtype)
+        self.u = np.zeros((nz, ny, nx, 3), dtype=self.dtype)
+        self.phi = np.ones((nz, ny, nx), dtype=self.dtype)
+        self.t = 0
+
+        print("Type of collisionOperator:", type(self.collisionOperator))
+        self.g = self.collisionOperator.compute_feq(self.descriptor, self.phi, self.u, dtype=np.float64).astype(self.dtype)
+        self._g_buf = np.empty_like(self.g)
+
+    #cell coordinates in (x, y, z), see Lattice2D.X
+    @property
+    def X(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[0]
+
+    @property
+    def Y(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[1]
+
+    @property
+    def Z(self):
+        return coordinate_grid((self.nx, self.ny, self.nz))[2]
+
+    def grid(self, sparse=False):
+        return coordinate_grid((self.nx, self.ny, self.nz), sparse)
+
+    def addOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
+        self.geometry[name] = operator
+
+    def save_checkpoint(self, filename, dtype=None):
+        #see Lattice2D.save_checkpoint
+        write_checkpoint(filename, self, dtype)
+
+    def load_checkpoint(self, filename):
+        read_checkpoint(filename, self)
+
+    def step(self):
+        # --- Streaming & Collision ---
+        stream_collide_advdiff(
+            self.g, self._g_buf, self.u, self.phi,
+            self.descriptor.e,
+            self.descriptor.w,
+            self.collisionOperator.tau,
+            1.0 / self.descriptor.cs2
+        )
+        self.g, self._g_buf = self._g_buf, self.g
+
+        # --- Boundary conditions ---
+        for operator in self.geometry.values():
+            operator.apply(self.g, self.u, self.phi)
+
+        self.t += 1
+
+##Coupled flow + scalar lattices
+#one pass per cell streams f and g, computes rho, u and phi, relaxes f (any collision model, optionally with a
+#Boussinesq force) and then relaxes g with the velocity that was just computed, so u never makes a round trip
+#through memory between the two lattices. The force F = rho * buoyancy * (phi - phi_ref) is added with the exact
+#difference method (f += feq(rho, u + F/rho) - feq(rho, u) after the collision), which works for BGK, TRT and MRT
+#alike. The stored u is the physical velocity u + F/(2 rho)
+
+@njit(parallel=True)
+def stream_collide_coupled2D(f, f_new, g, g_new, u, rho, phi, e, w, relax, shift, eg, wg, tau_g, inv_cs2, buoyancy, phi_ref, scratch, monitor, skip):
+    ny, nx, Q = f.shape
+    Qg = g.shape[2]
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
+    omega_g = 1.0 / tau_g
+    forced = buoyancy[0] != 0.0 or buoyancy[1] != 0.0
+
+    for y in prange(ny):
+        feq_c = scratch[y, 0]
+        feq_f = scratch[y, 1]
+        neq = scratch[y, 2]
+        for x in range(nx):
+            #scalar streaming + phi
+            phi_local = 0.0
+            for i in range(Qg):
+                gval = g[(y - eg[i, 1]) % ny, (x - eg[i, 0]) % nx, i]
+                g_new[y, x, i] = gval
+                phi_local += gval
+            phi[y, x] = phi_local
+
+            #flow streaming + moments
+            rho_local = 0.0
+            ux = 0.0
+            uy = 0.0
+            for i in range(Q):
+                fval = f[(y - e[i, 1]) % ny, (x - e[i, 0]) % nx, i]
+                f_new[y, x, i] = fval
+                rho_local += fval
+                ux += fval * e[i, 0]
+                uy += fval * e[i, 1]
+            rho_local += shift
+            ux = ux / (rho_local + 1e-10)
+            uy = uy / (rho_local + 1e-10)
+
+            fc = f_new[y, x]
+            equilibrium_cell2D(feq_c, rho_local, ux, uy, e, w, shift)
+            relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+            if forced:
+                dux = buoyancy[0] * (phi_local - phi_ref)
+                duy = buoyancy[1] * (phi_local - phi_ref)
+                equilibrium_cell2D(feq_f, rho_local, ux + dux, uy + duy, e, w, shift)
+                for i in range(Q):
+                    fc[i] += feq_f[i] - feq_c[i]
+                ux += 0.5 * dux
+                uy += 0.5 * duy
+            if track and skip[y, x] == 0:
+                monitor[y, 0] += (ux - u[y, x, 0])**2 + (uy - u[y, x, 1])**2
+                monitor[y, 1] += ux**2 + uy**2
+            rho[y, x] = rho_local
+            u[y, x, 0] = ux
+            u[y, x, 1] = uy
+
+            #scalar collision with the fresh velocity
+            for i in range(Qg):
+                cu = ux * eg[i, 0] + uy * eg[i, 1]
+                geq = wg[i] * phi_local * (1 + inv_cs2 * cu)
+                g_new[y, x, i] += -omega_g * (g_new[y, x, i] - geq)
+
+@njit(parallel=True)
+def stream_collide_coupled(f, f_new, g, g_new, u, rho, phi, e, w, relax, shift, eg, wg, tau_g, inv_cs2, buoyancy, phi_ref, scratch, monitor, skip):
+    #3D version of stream_collide_coupled2D (D3Q19 flow, D3Q7 scalar)
+    nz, ny, nx, Q = f.shape
+    Qg = g.shape[3]
+    model, omega, omega_m, K, opp = relax
+    track = monitor.shape[0] > 0
+    omega_g = 1.0 / tau_g
+    forced = buoyancy[0] != 0.0 or buoyancy[1] != 0.0 or buoyancy[2] != 0.0
+
+    for z in prange(nz):
+        feq_c = scratch[z, 0]
+        feq_f = scratch[z, 1]
+        neq = scratch[z, 2]
+        for y in range(ny):
+            for x in range(nx):
+                phi_local = 0.0
+                for i in range(Qg):
+                    gval = g[(z - eg[i, 2]) % nz, (y - eg[i, 1]) % ny, (x - eg[i, 0]) % nx, i]
+                    g_new[z, y, x, i] = gval
+                    phi_local += gval
+                phi[z, y, x] = phi_local
+
+                rho_local = 0.0
+                ux = 0.0
+                uy = 0.0
+                uz = 0.0
+                for i in range(Q):
+                    fval = f[(z - e[i, 2]) % nz, (y - e[i, 1]) % ny, (x - e[i, 0]) % nx, i]
+                    f_new[z, y, x, i] = fval
+                    rho_local += fval
+                    ux += fval * e[i, 0]
+                    uy += fval * e[i, 1]
+                    uz += fval * e[i, 2]
+                rho_local += shift
+                ux = ux / (rho_local + 1e-10)
+                uy = uy / (rho_local + 1e-10)
+                uz = uz / (rho_local + 1e-10)
+
+                fc = f_new[z, y, x]
+                equilibrium_cell3D(feq_c, rho_local, ux, uy, uz, e, w, shift)
+                relax_cell(fc, feq_c, model, omega, omega_m, K, opp, neq)
+                if forced:
+                    dux = buoyancy[0] * (phi_local - phi_ref)
+                    duy = buoyancy[1] * (phi_local - phi_ref)
+                    duz = buoyancy[2] * (phi_local - phi_ref)
+                    equilibrium_cell3D(feq_f, rho_local, ux + dux, uy + duy, uz + duz, e, w, shift)
+                    for i in range(Q):
+                        fc[i] += feq_f[i] - feq_c[i]
+                    ux += 0.5 * dux
+                    uy += 0.5 * duy
+                    uz += 0.5 * duz
+                if track and skip[z, y, x] == 0:
+                    monitor[z, 0] += (ux - u[z, y, x, 0])**2 + (uy - u[z, y, x, 1])**2 + (uz - u[z, y, x, 2])**2
+                    monitor[z, 1] += ux**2 + uy**2 + uz**2
+                rho[z, y, x] = rho_local
+                u[z, y, x, 0] = ux
+                u[z, y, x, 1] = uy
+                u[z, y, x, 2] = uz
+
+                for i in range(Qg):
+                    cu = ux * eg[i, 0] + uy * eg[i, 1] + uz * eg[i, 2]
+                    geq = wg[i] * phi_local * (1 + inv_cs2 * cu)
+                    g_new[z, y, x, i] += -omega_g * (g_new[z, y, x, i] - geq)
+
+
+class CoupledLattice2D(Lattice2D):
+    """ Navier-Stokes lattice with an advection diffusion scalar (e.g. temperature) riding along: f and g are
+    streamed and collided in the same kernel, replaces stepping a Lattice2D and a ScalarLattice2D one after another.
+    buoyancy = (gx, gy) is g * beta (thermal expansion) in lattice units, with it the scalar pushes the flow back
+    (Boussinesq, F = rho * buoyancy * (phi - phi_ref)). Flow operators go through addOperator, scalar operators
+    (ConstantScalarDirichlet, ZeroGradientOutlet, ...) through addScalarOperator. Only streaming="pull" and
+    layout="aos" are supported """
+    CHECKPOINT_FIELDS = ("f", "rho", "u", "g", "phi")
+
+    def __init__(self, nx, ny, descriptor, collisionOperator, scalarDescriptor, scalarCollisionOperator,
+                 buoyancy=None, phi_ref=1.0, dtype=np.float64, store_deviation=False):
+        super().__init__(nx, ny, descriptor, collisionOperator, dtype=dtype, store_deviation=store_deviation)
+        self.scalarDescriptor = scalarDescriptor
+        self.scalarCollisionOperator = scalarCollisionOperator
+        self.buoyancy = np.zeros(2) if buoyancy is None else np.asarray(buoyancy, dtype=np.float64)
+        self.phi_ref = phi_ref
+        self.scalar_geometry = {}
+
+        #scalar field and populations (phi = 1 everywhere like ScalarLattice2D)
+        self.phi = np.ones((ny, nx), dtype=self.dtype)
+        self.g = self.scalarCollisionOperator.compute_feq(self.scalarDescriptor, self.phi, self.u, dtype=np.float64).astype(self.dtype)
+        self._g_buf = np.empty_like(self.g)
+
+    def addScalarOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
+        self.scalar_geometry[name] = operator
+
+    def step(self):
+        stream_collide_coupled2D(
+            self.f, self._f_buf, self.g, self._g_buf, self.u, self.rho, self.phi,
+            self.e,
+            self.descriptor.w,
+            self._relax,
+            self.f_shift,
+            self.scalarDescriptor.e,
+            self.scalarDescriptor.w,
+            self.scalarCollisionOperator.tau,
+            1.0 / self.scalarDescriptor.cs2,
+            self.buoyancy,
+            self.phi_ref,
+            self._scratch,
+            self._monitor,
+            self._skip
+        )
+        self.f, self._f_buf = self._f_buf, self.f
+        self.g, self._g_buf = self._g_buf, self.g
+
+        #flow boundaries first, the scalar ones then see the boundary velocities
+        for operator in self.geometry.values():
+            operator.apply(self.f, self.u, self.rho)
+        for operator in self.scalar_geometry.values():
+            operator.apply(self.g, self.u, self.phi)
+
+        self.t += 1
+
+
+class CoupledLattice3D(Lattice3D):
+    #3D version of CoupledLattice2D, meant for D3Q19 flow + D3Q7 scalar. buoyancy is (gx, gy, gz)
+    CHECKPOINT_FIELDS = ("f", "rho", "u", "g", "phi")
+
+    def __init__(self, nx, ny, nz, descriptor, collisionOperator, scalarDescriptor, scalarCollisionOperator,
+                 buoyancy=None, phi_ref=1.0, dtype=np.float64, store_deviation=False):
+        super().__init__(nx, ny, nz, descriptor, collisionOperator, dtype=dtype, store_deviation=store_deviation)
+        self.scalarDescriptor = scalarDescriptor
+        self.scalarCollisionOperator = scalarCollisionOperator
+        self.buoyancy = np.zeros(3) if buoyancy is None else np.asarray(buoyancy, dtype=np.float64)
+        self.phi_ref = phi_ref
+        self.scalar_geometry = {}
+
+        self.phi = np.ones((nz, ny, nx), dtype=self.dtype)
+        self.g = self.scalarCollisionOperator.compute_feq(self.scalarDescriptor, self.phi, self.u, dtype=np.float64).astype(self.dtype)
+        self._g_buf = np.empty_like(self.g)
+
+    def addScalarOperator(self, name, operator):
+        if hasattr(operator, "bind"):
+            operator.bind(self)
+        self.scalar_geometry[name] = operator
+
+    def step(self):
+        stream_collide_coupled(
+            self.f, self._f_buf, self.g, self._g_buf, self.u, self.rho, self.phi,
+            self.descriptor.e,
+            self.descriptor.w,
+            self._relax,
+            self.f_shift,
+            self.scalarDescriptor.e,
+            self.scalarDescriptor.w,
+            self.scalarCollisionOperator.tau,
+            1.0 / self.scalarDescriptor.cs2,
+            self.buoyancy,
+            self.phi_ref,
+            self._scratch,
+            self._monitor,
+            self._skip
+        )
+        self.f, self._f_buf = self._f_buf, self.f
+        self.g, self._g_buf = self._g_buf, self.g
+
+        for operator in self.geometry.values():
+            operator.apply(self.f, self.u, self.rho)
+        for operator in self.scalar_geometry.values():
+            operator.apply(self.g, self.u, self.phi)
+
+        self.t += 1
+
+class SubcycledCoupling:
+    """ Coupling driver for a flow lattice (Lattice2D/3D) and a scalar lattice (ScalarLattice2D/3D) when the
+    scalar is much slower than the flow. Every step() advances the scalar by one step, the flow is only stepped
+    every flow_interval scalar steps (flow_interval=1 is the usual step both loop) and with tol set it gets frozen
+    for good once it is steady: every check_interval flow steps the largest velocity change since the last check,
+    relative to the largest velocity, is compared against tol.
+    The scalar lattice shares the velocity array of the flow lattice (no copy per step), so don't reassign flow.u """
+    def __init__(self, flow, scalar, flow_interval=1, tol=None, check_interval=100):
+        if flow_interval < 1:
+            raise ValueError(f"flow_interval has to be >= 1, got {flow_interval}")
+        self.flow = flow
+        self.scalar = scalar
+        self.flow_interval = flow_interval
+        self.tol = tol
+        self.check_interval = check_interval
+        self.scalar.u = self.flow.u
+
+        self.flow_frozen = False
+        self.flow_steps = 0
+        #relative velocity change at the last check (None until the first one)
+        self.flow_residual = None
+        self.t = 0
+        self._u_check = self.flow.u.copy() if tol is not None else None
+
+    def step(self):
+        if not self.flow_frozen and self.t % self.flow_interval == 0:
+            self.flow.step()
+            self.flow_steps += 1
+            if self.tol is not None and self.flow_steps % self.check_interval == 0:
+                self._check_flow()
+        self.scalar.step()
+        self.t += 1
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.step()
+
+    def _check_flow(self):
+        u = self.flow.u
+        self.flow_residual = np.abs(u - self._u_check).max() / (np.abs(u).max() + 1e-30)
+        self._u_check[...] = u
+        if self.flow_residual < self.tol:
+            self.flow_frozen = True
+
 def PrintLatticeInformation(nslattice, adlattice=None):
     print("\n" + "=" * 60)
     print("LATTICE INFORMATION".center(60))
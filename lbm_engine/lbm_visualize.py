@@ -1,7 +1,14 @@
 import matplotlib.pyplot as plt
 import os 
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
 from pyevtk.hl import imageToVTK
 import numpy as np
+from numba import njit, prange
 
 """ This file contains some basic visualization files that can create plots using matplotlib as well as VTK Files for Paraview
 The visualization methods are kinda ugly and have to be rewritten because of scaling and layout but it works for now so..... """
@@ -41,16 +48,22 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-def visualize_combined(sim, t, overall_title=None, scale = 10, dpi =150):
+def visualize_combined(sim, t, overall_title=None, scale = 10, dpi =150, stride=1, roi=None):
+    # only every stride-th cell of roi = ((x0, x1), (y0, y1)) is plotted, these are just views so nothing gets copied
+    (x0, x1), (y0, y1) = roi if roi is not None else ((0, sim.nx), (0, sim.ny))
+    view = (slice(y0, y1, stride), slice(x0, x1, stride))
+
     # Compute velocity magnitude
-    vmag = np.sqrt(sim.u[:, :, 0]**2 + sim.u[:, :, 1]**2)
-    phi = sim.phi
+    u = sim.u[view]
+    vmag = np.sqrt(u[:, :, 0]**2 + u[:, :, 1]**2)
+    phi = sim.phi[view]
 
     # Mask obstacles with NaN
     if "obstacle" in sim.geometry:
         mask = sim.geometry["obstacle"].mask
-        if mask.shape != vmag.shape:
+        if mask.shape != sim.phi.shape:
             mask = mask.T
+        mask = mask[view]
         vmag = vmag.copy()
         phi = phi.copy()
         vmag[mask] = np.nan
@@ -138,33 +151,291 @@ def export_fields_vti2D(timestep, u, phi=None, output_dir="output_vti"):
         pointData=point_data
     )
 
-def export_fields_vti3D(timestep, u, phi=None, output_dir="output_vti"):
+@njit(parallel=True)
+def sample_vtk(a, x0, x1, y0, y1, z0, z1, sx, sy, sz, average):
+    #takes a (z, y, x) field and writes every sx/sy/sz-th cell of the box [x0, x1) x [y0, y1) x [z0, z1) straight
+    #into a (x, y, z) array for VTK, with average the whole sx*sy*sz block is averaged instead (blocks at the end
+    #of the box can be smaller). Nothing but the small output array is allocated
+    nxo = (x1 - x0 + sx - 1) // sx
+    nyo = (y1 - y0 + sy - 1) // sy
+    nzo = (z1 - z0 + sz - 1) // sz
+    out = np.empty((nxo, nyo, nzo), dtype=a.dtype)
+    for i in prange(nxo):
+        x = x0 + i * sx
+        for j in range(nyo):
+            y = y0 + j * sy
+            for k in range(nzo):
+                z = z0 + k * sz
+                if not average:
+                    out[i, j, k] = a[z, y, x]
+                    continue
+                acc = 0.0
+                count = 0
+                for zz in range(z, min(z + sz, z1)):
+                    for yy in range(y, min(y + sy, y1)):
+                        for xx in range(x, min(x + sx, x1)):
+                            acc += a[zz, yy, xx]
+                            count += 1
+                out[i, j, k] = acc / count
+    return out
+
+
+def _box(shape, roi):
+    #roi = ((x0, x1), (y0, y1), (z0, z1)) in cells, None (or a None entry) means the whole extent
+    nz, ny, nx = shape
+    roi = (None, None, None) if roi is None else roi
+    return [(0, n) if r is None else (max(int(r[0]), 0), min(int(r[1]), n)) for r, n in zip(roi, (nx, ny, nz))]
+
+
+def downsample_field3D(field, stride=1, average=False, roi=None):
+    """ (z, y, x) field -> (x, y, z) array for VTK, cut to roi and downsampled by stride (int or (sx, sy, sz)),
+    average=True averages stride blocks instead of just picking every stride-th cell """
+    strides = (stride,) * 3 if np.isscalar(stride) else tuple(stride)
+    (x0, x1), (y0, y1), (z0, z1) = _box(field.shape, roi)
+    return sample_vtk(field, x0, x1, y0, y1, z0, z1, *strides, average)
+
+
+def export_fields_vti3D(timestep, u, phi=None, output_dir="output_vti", stride=1, average=False, roi=None, name="fields"):
     # u: (nz, ny, nx, 3) – velocity field
     # phi: (nz, ny, nx) – optional scalar field (e.g., density, temperature)
-    nz, ny, nx = u.shape[:3]
-    spacing = (1.0, 1.0, 1.0)
-    origin = (0.0, 0.0, 0.0)
-
-    # Transpose from (z, y, x) to (x, y, z) fdor VTK
-    u_x = np.ascontiguousarray(np.transpose(u[:, :, :, 0], (2, 1, 0)))
-    u_y = np.ascontiguousarray(np.transpose(u[:, :, :, 1], (2, 1, 0)))
-    u_z = np.ascontiguousarray(np.transpose(u[:, :, :, 2], (2, 1, 0)))
+    # stride/average/roi only write a downsampled part of the domain (see downsample_field3D), the spacing and origin
+    # of the vti are set so it still sits at the right place in paraview
+    strides = (stride,) * 3 if np.isscalar(stride) else tuple(stride)
+    box = _box(u.shape[:3], roi)
+    spacing = tuple(float(s) for s in strides)
+    #an averaged block is drawn at its center
+    origin = tuple(b[0] + ((s - 1) / 2 if average else 0.0) for b, s in zip(box, strides))
+
+    # Transpose from (z, y, x) to (x, y, z) for VTK, done by the sampling kernel
+    u_x = downsample_field3D(u[:, :, :, 0], strides, average, box)
+    u_y = downsample_field3D(u[:, :, :, 1], strides, average, box)
+    u_z = downsample_field3D(u[:, :, :, 2], strides, average, box)
 
     point_data = {
         "velocity": (u_x, u_y, u_z)
     }
 
     if phi is not None:
-        phi_3d = np.ascontiguousarray(np.transpose(phi, (2, 1, 0)))
-        point_data["phi"] = phi_3d
+        point_data["phi"] = downsample_field3D(phi, strides, average, box)
 
     os.makedirs(output_dir, exist_ok=True)
 
     imageToVTK(
-        os.path.join(output_dir, f"fields_{timestep:05d}"),
+        os.path.join(output_dir, f"{name}_{timestep:05d}"),
         origin=origin,
         spacing=spacing,
         pointData=point_data
     )
 
 
+def export_slice_vti3D(timestep, u, phi=None, axis=2, index=None, output_dir="output_vti", stride=1, average=False):
+    #single axis aligned plane (axis 0 = x, 1 = y, 2 = z, index defaults to the middle) as a flat vti
+    box = [None, None, None]
+    n = u.shape[2 - axis]
+    index = n // 2 if index is None else index
+    box[axis] = (index, index + 1)
+    strides = [stride] * 3 if np.isscalar(stride) else list(stride)
+    strides[axis] = 1
+    export_fields_vti3D(timestep, u, phi, output_dir, strides, average, box, name=f"slice_{'xyz'[axis]}{index}")
+
+
+class AsyncVTIWriter:
+    """ Writes the VTI files in a background thread so the step loop doesn't wait for the disk.
+    submit() only copies u (and phi) into one of n_buffers preallocated buffers, the transpose and imageToVTK
+    happen in the writer thread (numpy copies and the file writes release the GIL). If all buffers are still
+    waiting to be written, submit() blocks until one is free again (backpressure), so memory stays bounded.
+    Works for 2D (ny, nx, 2) and 3D (nz, ny, nx, 3) fields, export_kwargs (e.g. stride, average, roi for 3D) are
+    passed on to the export function, use it as a context manager or call close() at the end
+    so the last files get written. Errors of the writer thread are raised on the next submit()/flush()/close() """
+    def __init__(self, output_dir="output_vti", n_buffers=2, **export_kwargs):
+        self.output_dir = output_dir
+        self.n_buffers = n_buffers
+        self.export_kwargs = export_kwargs
+        self._buffers = None
+        self._free = queue.Queue()
+        self._jobs = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _allocate(self, u, phi):
+        #buffers are created on the first submit when we know the shapes
+        self._buffers = [[np.empty_like(u), None if phi is None else np.empty_like(phi)] for _ in range(self.n_buffers)]
+        for k in range(self.n_buffers):
+            self._free.put(k)
+
+    def submit(self, timestep, u, phi=None):
+        self._raise_error()
+        if self._buffers is None:
+            self._allocate(u, phi)
+        k = self._free.get()
+        u_buf, phi_buf = self._buffers[k]
+        np.copyto(u_buf, u)
+        if phi is not None:
+            #phi can show up after submits without it, the buffer is ours until the job is queued
+            if phi_buf is None:
+                phi_buf = self._buffers[k][1] = np.empty_like(phi)
+            np.copyto(phi_buf, phi)
+        self._jobs.put((timestep, k, phi is not None))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                break
+            timestep, k, has_phi = job
+            u_buf, phi_buf = self._buffers[k]
+            try:
+                if self._error is None:
+                    export = export_fields_vti3D if u_buf.ndim == 4 else export_fields_vti2D
+                    export(timestep, u_buf, phi_buf if has_phi else None, output_dir=self.output_dir, **self.export_kwargs)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._free.put(k)
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("AsyncVTIWriter failed to write a snapshot") from error
+
+    def flush(self):
+        #wait until everything submitted so far is on disk
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_png(filename, rgb, level=1, rows=None):
+    #minimal 8 bit RGB png writer (zlib + struct), rows is an optional (ny, 1 + 3 * nx) uint8 buffer to reuse
+    ny, nx = rgb.shape[:2]
+    if rows is None:
+        rows = np.empty((ny, 1 + 3 * nx), dtype=np.uint8)
+    rows[:, 0] = 0                                      #filter type "none" in front of every row
+    rows[:, 1:] = rgb.reshape(ny, 3 * nx)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    with open(filename, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", nx, ny, 8, 2, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(rows, level)))
+        file.write(chunk(b"IEND", b""))
+
+
+class FrameRenderer:
+    """ Fast replacement for visualize/visualizeScalar when lots of frames are written: the field is mapped through
+    a 256 color lookup table that is built once (any matplotlib colormap name or an (N, 3) array) and written
+    as png without any figure, colorbar or savefig. All buffers are reused between frames as long as the shape
+    doesn't change. vmin/vmax fix the color range (None = min/max of every frame), scale repeats every cell
+    scale x scale times, masked cells and NaNs get nan_color """
+    def __init__(self, cmap="coolwarm", vmin=None, vmax=None, scale=1, nan_color=(0, 0, 0), level=1):
+        colors = plt.get_cmap(cmap)(np.linspace(0.0, 1.0, 256))[:, :3] if isinstance(cmap, str) else np.asarray(cmap)
+        #one extra entry at the end for the masked cells
+        self.lut = np.empty((len(colors) + 1, 3), dtype=np.uint8)
+        self.lut[:-1] = np.round(np.asarray(colors, dtype=np.float64) * 255 if np.max(colors) <= 1.0 else colors)
+        self.lut[-1] = nan_color
+        self.vmin, self.vmax = vmin, vmax
+        self.scale = scale
+        self.level = level
+        self._shape = None
+        self._magnitude = None
+
+    def _allocate(self, shape):
+        ny, nx = shape
+        self._shape = shape
+        self._values = np.empty(shape)
+        self._index = np.empty(shape, dtype=np.intp)
+        self._rgb = np.empty((ny, nx, 3), dtype=np.uint8)
+        self._big = np.empty((ny * self.scale, nx * self.scale, 3), dtype=np.uint8) if self.scale > 1 else None
+        self._rows = np.empty((ny * self.scale, 1 + 3 * nx * self.scale), dtype=np.uint8)
+
+    def render(self, field, mask=None):
+        #(ny, nx) field -> (ny * scale, nx * scale, 3) uint8 image, row 0 on top like imshow
+        if field.shape != self._shape:
+            self._allocate(field.shape)
+        values, index = self._values, self._index
+        np.copyto(values, field)
+        invalid = np.isnan(values)
+        if mask is not None:
+            invalid |= np.asarray(mask, dtype=bool)
+        vmin = np.nanmin(values) if self.vmin is None else self.vmin
+        vmax = np.nanmax(values) if self.vmax is None else self.vmax
+        n = len(self.lut) - 1
+        values -= vmin
+        values *= n / (vmax - vmin) if vmax > vmin else 0.0
+        np.clip(values, 0, n - 1, out=values)
+        values[invalid] = n
+        index[...] = values
+        np.take(self.lut, index, axis=0, out=self._rgb)
+        if self._big is None:
+            return self._rgb
+        ny, nx = self._shape
+        self._big.reshape(ny, self.scale, nx, self.scale, 3)[...] = self._rgb[:, None, :, None, :]
+        return self._big
+
+    def save_png(self, filename, field, mask=None):
+        write_png(filename, self.render(field, mask), self.level, self._rows)
+
+    def save_frame(self, sim, t, field="velocity", output_dir="frames"):
+        #same frames as visualize/visualizeScalar: |u| or phi of a 2D lattice, the "obstacle" operator is masked
+        if field == "velocity":
+            if self._magnitude is None or self._magnitude.shape != sim.u.shape[:2]:
+                self._magnitude = np.empty(sim.u.shape[:2])
+            values = np.hypot(sim.u[:, :, 0], sim.u[:, :, 1], out=self._magnitude)
+        else:
+            values = getattr(sim, field)
+        mask = None
+        if "obstacle" in sim.geometry:
+            mask = sim.geometry["obstacle"].mask
+            mask = np.transpose(mask) if mask.shape != values.shape else mask
+        os.makedirs(output_dir, exist_ok=True)
+        self.save_png(os.path.join(output_dir, f"{field}_{t:05d}.png"), values, mask)
+
+
+class VideoPipe:
+    """ Streams rendered frames (e.g. FrameRenderer.render) as raw rgb24 into ffmpeg, so no png files are written
+    at all. The frame size is taken from the first frame, use it as a context manager or call close() """
+    def __init__(self, filename, fps=30, ffmpeg="ffmpeg", codec="libx264", extra_args=("-pix_fmt", "yuv420p")):
+        if shutil.which(ffmpeg) is None:
+            raise RuntimeError(f"'{ffmpeg}' not found, VideoPipe needs ffmpeg on the PATH")
+        self.filename = filename
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.codec = codec
+        self.extra_args = list(extra_args)
+        self._process = None
+
+    def write(self, rgb):
+        if self._process is None:
+            ny, nx = rgb.shape[:2]
+            command = [self.ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                       "-s", f"{nx}x{ny}", "-r", str(self.fps), "-i", "-", "-c:v", self.codec] + self.extra_args + [self.filename]
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self._process.stdin.write(memoryview(np.ascontiguousarray(rgb)).cast("B"))
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
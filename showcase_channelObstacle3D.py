@@ -4,7 +4,7 @@ from lbm_engine.lbm_geometry import load_mask_from_vti
 from lbm_engine.lbm_collisionOperators import BGK_collisionOperator3D
 from lbm_engine.lbm_simulationcore import Lattice3D
 from lbm_engine.lbm_operators import BounceBack3D, PressureDirichlet3D, VelocityDirichlet3D
-from lbm_engine.lbm_visualize import export_fields_vti3D
+from lbm_engine.lbm_visualize import AsyncVTIWriter
 
 #Basic Simulation Parameters
 nx, ny, nz = 100, 100, 100   #sim dimensions
@@ -18,7 +18,7 @@ collision = BGK_collisionOperator3D(tau=0.75)
 sim = Lattice3D(nx=nx, ny=ny, nz=nz, descriptor=descriptor, collisionOperator=collision)
 
 #easy, get the walls by geomtry definitons from our dimensions, kinda chill, shoutout OpenLB
-X, Y, Z = np.meshgrid(np.arange(nx), np.arange(ny), np.arange(nz), indexing="ij")
+X, Y, Z = sim.X, sim.Y, sim.Z   #broadcast views, no full coordinate arrays get allocated
 wall_mask = (Y == 0) | (Y == ny - 1) | (Z == 0) | (Z == nz - 1)
 
 #load geomtry from file using the load_mask_from_vti method
@@ -40,8 +40,10 @@ outlet_mask = (X == nx - 1)
 sim.addOperator("outlet", PressureDirichlet3D(descriptor, collision, outlet_mask, rho_value=1.0))
 
 # --- Main Simulation Loop ---
-for t in range(timesteps):
-    sim.step()
-    if t % plot_interval == 0:
-        print(f"Timestep {t} / {timesteps}")
-        export_fields_vti3D(t, sim.u, phi=sim.rho, output_dir="ShowCase3D_FlowAroundObject")
+#the vti files are written in a background thread while the next steps run
+with AsyncVTIWriter(output_dir="ShowCase3D_FlowAroundObject") as writer:
+    for t in range(timesteps):
+        sim.step()
+        if t % plot_interval == 0:
+            print(f"Timestep {t} / {timesteps}")
+            writer.submit(t, sim.u, phi=sim.rho)